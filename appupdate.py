@@ -11,7 +11,8 @@ from pathlib import Path
 import ccglobal
 import config
 from build.apkfile import ApkFile
-from util import adb, template, myoverlay
+from build.apkindex import ApkIndex
+from util import adb, template, myoverlay, trace
 
 
 class NewApp(object):
@@ -159,15 +160,20 @@ def pull_apks_from_device(new_apks: list[str], old_dir: str):
     if extract_lib:
         _7z = f'{ccglobal.LIB_DIR}/7za.exe'
         for new_apk in iglob(f'{old_dir}/*.apk'):
-            subprocess.run([_7z, 'e', '-aoa', new_apk, 'lib/arm64-v8a', f'-o{old_dir}/lib/arm64'], stdout=subprocess.DEVNULL)
+            trace.run([_7z, 'e', '-aoa', new_apk, 'lib/arm64-v8a', f'-o{old_dir}/lib/arm64'], stdout=subprocess.DEVNULL)
 
 
 def run_on_rom():
     if not adb.is_connected():
         return
     packages = set()
+    index = ApkIndex()
     for app in fetch_updated_apps():
-        rom_apk_version = ApkFile(f'{app.rom_old_dir}/{os.path.basename(app.rom_old_dir)}.apk').version_code()
+        rom_apk = f'{app.rom_old_dir}/{os.path.basename(app.rom_old_dir)}.apk'
+        if not (rom_apk_info := index.get(rom_apk)):
+            ccglobal.log(f'找不到 ROM 中的 APK, 跳过更新: {rom_apk}')
+            continue
+        rom_apk_version = rom_apk_info.version_code
         if app.version_code < rom_apk_version:
             # Oplus has updated the apk in ROM
             continue
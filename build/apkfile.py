@@ -2,12 +2,17 @@ import os
 import shutil
 from glob import iglob
 from pathlib import Path
-from zipfile import ZipFile
+from typing import Iterable
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
+import ccglobal
 from util import apkeditor
+from . import dex
 from .axml import ManifestXml
 from .smali import SmaliFile
+from .smaliindex import SmaliIndex
 from .xml import XmlFile
+from .ziprepack import ZipRepacker
 
 _MODIFIED_FLAG = b'CC-Mod'
 
@@ -17,6 +22,11 @@ class ApkFile:
         self.file = file
         self.output = f'{self.file}.out'
         self._manifest_attributes = None
+        self._smali_files: dict[str, SmaliFile] = {}
+        self._smali_index: SmaliIndex | None = None
+        self._decoded_dex: list[str] | None = None
+        self._dex_classes: dict[str, str] | None = None
+        self._dex_files: dict[str, dex.DexFile] = {}
 
     def not_need_modify(self):
         if os.path.isfile(self.file):
@@ -24,18 +34,36 @@ class ApkFile:
                 return f.comment == _MODIFIED_FLAG
         return True
 
-    def decode(self, *, no_res=True):
-        if no_res:
-            apkeditor.decode(self.file, self.output, 'raw')
-        else:
-            apkeditor.decode(self.file, self.output)
+    def decode(self, *, no_res=True, dex_only=False):
+        self._smali_files.clear()
+        self._smali_index = None
+        self._decoded_dex = None
+        self._dex_classes = None
+        self._dex_files.clear()
+        if dex_only or no_res:
+            # Only the dex are disassembled and later rebuilt, all other entries are copied from the original file on build.
+            # In dex only mode nothing is disassembled up front, each dex is decoded when one of its classes is opened
+            self._decoded_dex = []
+            if not dex_only:
+                with ZipFile(self.file, 'r') as f:
+                    self._decode_dex(filter(dex.is_dex_entry, f.namelist()))
+                # Every class is decoded already, there is nothing to look up
+                self._dex_classes = {}
+            return
+        apkeditor.decode(self.file, self.output)
 
     def build(self, *, remove_oat=True):
-        apkeditor.build(self.output, self.file)
-        shutil.rmtree(self.output)
-
-        with ZipFile(self.file, 'a') as f:
-            f.comment = _MODIFIED_FLAG
+        self._commit_smali()
+        self._smali_files.clear()
+        self._smali_index = None
+        if self._decoded_dex is not None:
+            self._build_dex()
+        else:
+            built_file = f'{self.file}.build'
+            apkeditor.build(self.output, built_file)
+            shutil.rmtree(self.output)
+            self._repack(built_file)
+            os.remove(built_file)
 
         if remove_oat and (oat := Path(self.file).parent.joinpath('oat')).exists():
             shutil.rmtree(oat)
@@ -47,32 +75,49 @@ class ApkFile:
         os.remove(old_file)
 
     def open_smali(self, file: str):
+        if self._decoded_dex is not None:
+            if name := self._find_dex(f'L{file.removesuffix('.smali')};'):
+                self._decode_dex((name,))
         for smali_dir in iglob(f'{self.output}/smali/*'):
             assumed_path = f'{smali_dir}/{file}'
             if os.path.exists(assumed_path):
-                return SmaliFile(assumed_path)
+                return self._open_smali_file(assumed_path)
         return None
 
+    def open_dex_class(self, file: str):
+        # Stubs are written straight into the bytecode, only available before the dex is decoded to smali
+        if self._decoded_dex is None:
+            raise RuntimeError('Dex classes can only be opened in dex only mode')
+        descriptor = f'L{file};'
+        if not (name := self._find_dex(descriptor)):
+            return None
+        if name in self._decoded_dex:
+            raise RuntimeError(f'{name} is already decoded: {self.file}')
+        if name not in self._dex_files:
+            with ZipFile(self.file, 'r') as f:
+                self._dex_files[name] = dex.DexFile(f.read(name))
+        return dex.DexClass(self._dex_files[name], descriptor)
+
     def find_smali(self, *keywords: str, package: str = None):
-        package_path = f'{package}/' if package else ''
-        results = set[SmaliFile]()
-        # See: https://docs.python.org/3/using/windows.html#removing-the-max-path-limitation
-        for file in iglob(f'{self.output}/smali/classes*/{package_path}**/*.smali', recursive=True):
-            keyword_set = set(keywords)
-            with open(file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    for keyword in keywords:
-                        if keyword in line:
-                            keyword_set.discard(keyword)
-            if len(keyword_set) == 0:
-                results.add(SmaliFile(file))
-        return results
+        return self.find_smali_many(keywords, package=package)[0]
+
+    def find_smali_many(self, *queries: tuple[str, ...], package: str = None) -> list[set[SmaliFile]]:
+        # Keywords are verified on disk, pending edits need to be written first
+        self._commit_smali()
+        if self._decoded_dex is not None:
+            with ZipFile(self.file, 'r') as f:
+                self._decode_dex(filter(dex.is_dex_entry, f.namelist()))
+        if self._smali_index is None:
+            self._smali_index = SmaliIndex(f'{self.output}/smali')
+        return [set(self._open_smali_file(x) for x in files) for files in self._smali_index.search(queries, package)]
 
     def add_smali(self, src_path: str, full_smali_path: str):
         smali_dir = sorted(os.listdir(f'{self.output}/smali'), reverse=True)[0]
         dst_path = Path(f'{self.output}/smali/{smali_dir}/{full_smali_path}')
         dst_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copy(src_path, dst_path)
+        if self._smali_index:
+            self._smali_index.update(os.fspath(dst_path))
 
     def open_xml(self, file: str):
         return XmlFile(f'{self.output}/resources/package_1/res/{file}')
@@ -92,7 +137,103 @@ class ApkFile:
             self._parse_manifest()
         return self._manifest_attributes['uses-sdk']['android:minSdkVersion']
 
+    def _decode_dex(self, names: Iterable[str]):
+        names = sorted(set(names) - set(self._decoded_dex), key=dex.dex_index)
+        if not names:
+            return
+        ccglobal.log(f'反编译 {', '.join(names)}: {self.file}')
+        dex_file = f'{self.file}.dex'
+        dex_output = f'{self.file}.dex.out'
+        with ZipFile(self.file, 'r') as zip_file, open(self.file, 'rb') as src, open(dex_file, 'wb') as dst:
+            repacker = ZipRepacker(dst)
+            for name in names:
+                # Stubs already patched into the bytecode are carried over into the smali
+                if name in self._dex_files:
+                    repacker.write(zip_file.getinfo(name), self._dex_files.pop(name).to_bytes())
+                else:
+                    repacker.copy(src, zip_file.getinfo(name))
+            repacker.close()
+        apkeditor.decode(dex_file, dex_output, 'raw')
+        os.remove(dex_file)
+
+        if not os.path.isdir(self.output):
+            os.rename(dex_output, self.output)
+        else:
+            for smali_dir in os.listdir(f'{dex_output}/smali'):
+                os.rename(f'{dex_output}/smali/{smali_dir}', f'{self.output}/smali/{smali_dir}')
+            shutil.rmtree(dex_output)
+        self._decoded_dex += names
+
+    def _build_dex(self):
+        # Only the decoded and patched dex are replaced, all other entries are copied from the original file as they are
+        built = {name: x.to_bytes() for name, x in self._dex_files.items() if x.is_modified()}
+        if self._decoded_dex:
+            dex_file = f'{self.file}.dex'
+            apkeditor.build(self.output, dex_file)
+            shutil.rmtree(self.output)
+            with ZipFile(dex_file, 'r') as f:
+                built |= {x: f.read(x) for x in f.namelist() if dex.is_dex_entry(x)}
+            os.remove(dex_file)
+
+        new_file = f'{self.file}.new'
+        with ZipFile(self.file, 'r') as zip_file, open(self.file, 'rb') as src, open(new_file, 'wb') as dst:
+            repacker = ZipRepacker(dst)
+            for info in zip_file.infolist():
+                if info.filename in built:
+                    repacker.write(info, built.pop(info.filename))
+                else:
+                    repacker.copy(src, info)
+            for name, data in sorted(built.items(), key=lambda x: dex.dex_index(x[0])):
+                info = ZipInfo(name, zip_file.infolist()[0].date_time)
+                info.compress_type = ZIP_DEFLATED
+                repacker.write(info, data)
+            repacker.close(_MODIFIED_FLAG)
+        os.replace(new_file, self.file)
+        self._decoded_dex = None
+        self._dex_classes = None
+        self._dex_files.clear()
+
+    def _repack(self, built_file: str):
+        # Only the entries APKEditor rebuilt from decoded sources are taken from its output, everything else is copied
+        # from the original file as it is
+        new_file = f'{self.file}.new'
+        with (ZipFile(self.file, 'r') as original_zip, ZipFile(built_file, 'r') as built_zip,
+              open(self.file, 'rb') as original_src, open(built_file, 'rb') as built_src, open(new_file, 'wb') as dst):
+            built_infos = {x.filename: x for x in built_zip.infolist() if _is_rebuilt(x.filename)}
+            repacker = ZipRepacker(dst)
+            for info in original_zip.infolist():
+                if info.filename in built_infos:
+                    repacker.copy(built_src, built_infos.pop(info.filename))
+                elif not _is_rebuilt(info.filename):
+                    repacker.copy(original_src, info)
+            for info in built_infos.values():
+                repacker.copy(built_src, info)
+            repacker.close(_MODIFIED_FLAG)
+        os.replace(new_file, self.file)
+
+    def _find_dex(self, descriptor: str):
+        if self._dex_classes is None:
+            self._dex_classes = dex.class_map(self.file)
+        return self._dex_classes.get(descriptor)
+
+    def _open_smali_file(self, file: str):
+        # Edits to the same class accumulate in one instance and are written on build
+        key = os.path.normcase(os.path.abspath(file))
+        if key not in self._smali_files:
+            self._smali_files[key] = SmaliFile(file)
+        return self._smali_files[key]
+
+    def _commit_smali(self):
+        for smali in self._smali_files.values():
+            if smali.commit() and self._smali_index:
+                self._smali_index.update(smali.file)
+
     def _parse_manifest(self):
         with ZipFile(self.file, 'r') as zip_file:
             f = zip_file.open('AndroidManifest.xml', 'r')
             self._manifest_attributes = ManifestXml(f.read()).attributes
+
+
+def _is_rebuilt(name: str):
+    # Decoded resources may be renamed on build, so the whole res directory is replaced
+    return dex.is_dex_entry(name) or name in ('AndroidManifest.xml', 'resources.arsc') or name.startswith('res/')
@@ -0,0 +1,115 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import iglob
+from zipfile import ZipFile
+
+import ccglobal
+import config
+from .axml import ManifestXml
+
+_INDEX_JSON = f'{ccglobal.CACHE_DIR}/apk_index.json'
+_BATCH_SIZE = 50
+
+
+class ApkInfo:
+    def __init__(self, path: str, package: str, version_code: int, min_sdk_version: int | None, extract_native_libs: bool | None,
+                 native_abis: list[str]):
+        self.path = path
+        self.package = package
+        self.version_code = version_code
+        self.min_sdk_version = min_sdk_version
+        self.extract_native_libs = extract_native_libs
+        self.native_abis = native_abis
+
+
+class ApkIndex:
+    # Manifest summary of every apk in the unpacked partitions, entries are reused while the size and mtime of apk are unchanged
+    def __init__(self, partitions: tuple[str, ...] = config.UNPACK_PARTITIONS):
+        self._apks: dict[str, ApkInfo] = {}
+        self._packages: dict[str, list[ApkInfo]] = {}
+
+        cache = _load_cache()
+        files = sorted(x.replace('\\', '/') for partition in partitions for x in iglob(f'{partition}/**/*.apk', recursive=True))
+        records = {}
+        pending = []
+        for file in files:
+            stat = os.stat(file)
+            key = os.path.abspath(file)
+            record = cache.get(key)
+            if record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+                records[key] = record
+            else:
+                pending.append(file)
+
+        if pending:
+            ccglobal.log(f'索引 APK: {len(pending)} 个')
+            batches = [pending[i:i + _BATCH_SIZE] for i in range(0, len(pending), _BATCH_SIZE)]
+            with ProcessPoolExecutor(config.APK_INDEX_JOBS) as executor:
+                for result in executor.map(_scan, batches):
+                    for key, record in result.items():
+                        if error := record.pop('error', None):
+                            ccglobal.log(f'解析 APK 失败: {os.path.relpath(key)}, {error}')
+                    records.update(result)
+            cache.update(records)
+            _save_cache(cache)
+
+        for file in files:
+            if (record := records.get(os.path.abspath(file))) and record['package']:
+                info = ApkInfo(file, record['package'], record['version_code'], record['min_sdk_version'],
+                               record['extract_native_libs'], record['native_abis'])
+                self._apks[file] = info
+                self._packages.setdefault(info.package, []).append(info)
+
+    def get(self, path: str) -> ApkInfo | None:
+        return self._apks.get(os.path.normpath(path).replace('\\', '/'))
+
+    def find(self, package: str) -> list[ApkInfo]:
+        return self._packages.get(package, [])
+
+
+def _scan(files: list[str]):
+    results = {}
+    for file in files:
+        stat = os.stat(file)
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'package': None}
+        try:
+            # Only the central directory and the manifest entry are read
+            with ZipFile(file, 'r') as zip_file:
+                abis = {x.split('/')[1] for x in zip_file.namelist() if x.startswith('lib/') and x.count('/') >= 2}
+                attributes = ManifestXml(zip_file.read('AndroidManifest.xml')).attributes
+        except Exception as e:
+            # Broken files are recorded too, so that they are not scanned again. The worker can't log in order with the main
+            # process, the error is passed back instead
+            record['error'] = f'{type(e).__name__}: {e}'
+            results[os.path.abspath(file)] = record
+            continue
+
+        record.update({
+            'package': attributes.get('package'),
+            'version_code': attributes.get('android:versionCode'),
+            'min_sdk_version': attributes.get('uses-sdk', {}).get('android:minSdkVersion'),
+            'extract_native_libs': attributes.get('application', {}).get('android:extractNativeLibs'),
+            'native_abis': sorted(abis),
+        })
+        results[os.path.abspath(file)] = record
+    return results
+
+
+def _load_cache() -> dict[str, dict]:
+    if not os.path.isfile(_INDEX_JSON):
+        return {}
+    with open(_INDEX_JSON, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except json.decoder.JSONDecodeError:
+            return {}
+
+
+def _save_cache(cache: dict[str, dict]):
+    # Apks that no longer exist are dropped
+    cache = {x: record for x, record in cache.items() if os.path.isfile(x)}
+    os.makedirs(ccglobal.CACHE_DIR, exist_ok=True)
+    with open(f'{_INDEX_JSON}.tmp', 'w', encoding='utf-8', newline='') as f:
+        json.dump(cache, f)
+    os.replace(f'{_INDEX_JSON}.tmp', _INDEX_JSON)
@@ -1,161 +1,191 @@
-import os
 import struct
-from io import BytesIO
-
-
-class Chunk:
-    SIZE = 8
-    __FORMAT_STRING = '<2HI'  # type, header size, size (chunk)
-
-    def __init__(self, f: BytesIO):
-        (self.type, self.header_size, self.size) = struct.unpack(self.__FORMAT_STRING, f.read(self.SIZE))
-
-
-class StringChunk(Chunk):
-    # @formatter:off
-    __FORMAT_STRING = ('<2I'  # string count, style count
-                      '2H'    # utf-8, sorted (flags)
-                      '2I')   # strings start, styles start
-    # @formatter:on
-
-    def __init__(self, f: BytesIO):
-        super().__init__(f)
-        buff = f.read(struct.calcsize(self.__FORMAT_STRING))
-        (self.string_count, _, self._flag_utf8, _, self.strings_start, _) = struct.unpack(self.__FORMAT_STRING, buff)
-        self.is_utf8 = self._flag_utf8 != 0
-
-        self.string_offsets = []
-        for i in range(self.string_count):
-            self.string_offsets.append(struct.unpack('<I', f.read(4))[0])
-
-        self.string_pool = f.read(self.size - self.strings_start)
-
-
-class StartNamespaceChunk(Chunk):
-    __FORMAT_STRING = ('<2I'  # line number, comment
-                       '2I')  # prefix, uri (namespace)
-
-    def __init__(self, f: BytesIO):
-        super().__init__(f)
-        buff = f.read(struct.calcsize(self.__FORMAT_STRING))
-        (_, _, self.prefix, self.uri) = struct.unpack(self.__FORMAT_STRING, buff)
-
-
-class StartTagChunk(Chunk):
-    TYPE = 0x102
-    # @formatter:off
-    __FORMAT_STRING = ('<2I'  # line number, comment
-                      '2I'    # namespace uri, name
-                      '3H'    # start, size, count (attribute)
-                      '3H')   # id index, class index, style index
-    # @formatter:on
-
-    class Attribute:
-        SIZE = 20
-        # @formatter:off
-        __FORMAT_STRING = ('<3I'    # namespace uri, name, raw value
-                          'H2BI')   # size, res0, data type, data
-        # @formatter:on
-        DATA_TYPE_REFERENCE = 0x01
-        DATA_TYPE_STRING = 0x03
-        DATA_TYPE_BOOLEAN = 0x12
-
-        def __init__(self, f: BytesIO):
-            buff = f.read(struct.calcsize(self.__FORMAT_STRING))
-            (self.namespace_uri, self.name, _, _, _, self.data_type, self.data) = struct.unpack(self.__FORMAT_STRING, buff)
-
-    def __init__(self, f: BytesIO):
-        super().__init__(f)
-        buff = f.read(struct.calcsize(self.__FORMAT_STRING))
-        (_, _, self.namespace_uri, self.name, _, _, self.attribute_count, _, _, _) = struct.unpack(self.__FORMAT_STRING, buff)
-
-    def read_attribute(self, f: BytesIO):
-        attributes = []
-        for i in range(self.attribute_count):
-            attributes.append(StartTagChunk.Attribute(f))
-        return attributes
+import sys
+from array import array
+
+_CHUNK_FORMAT_STRING = '<2HI'  # type, header size, size (chunk)
+_CHUNK_SIZE = struct.calcsize(_CHUNK_FORMAT_STRING)
+_NODE_HEADER_SIZE = 16
+# @formatter:off
+_STRING_POOL_FORMAT_STRING = ('<2I'  # string count, style count
+                              'I'    # flags
+                              '2I')  # strings start, styles start
+_NAMESPACE_FORMAT_STRING = ('<2I'  # line number, comment
+                            '2I')  # prefix, uri (namespace)
+_START_TAG_FORMAT_STRING = ('<2I'   # line number, comment
+                            '2I'    # namespace uri, name
+                            '3H'    # start, size, count (attribute)
+                            '3H')   # id index, class index, style index
+_ATTRIBUTE_FORMAT_STRING = ('<3I'    # namespace uri, name, raw value
+                            'H2BI')  # size, res0, data type, data
+# @formatter:on
+_ATTRIBUTE_SIZE = struct.calcsize(_ATTRIBUTE_FORMAT_STRING)
+_TYPE_STRING_POOL = 0x001
+_TYPE_XML = 0x003
+_TYPE_START_NAMESPACE = 0x100
+_TYPE_START_TAG = 0x102
+_TYPE_END_TAG = 0x103
+_FLAG_UTF8 = 0x100
+_NO_INDEX = 0xffffffff
+
+DATA_TYPE_REFERENCE = 0x01
+DATA_TYPE_ATTRIBUTE = 0x02
+DATA_TYPE_STRING = 0x03
+DATA_TYPE_FLOAT = 0x04
+DATA_TYPE_INT_DEC = 0x10
+DATA_TYPE_BOOLEAN = 0x12
+
+
+class ResourceReference(int):
+    # Resource id of a reference attribute, resources.arsc is not parsed
+    def __repr__(self):
+        return f'@0x{self:08x}'
+
+
+class StringPool:
+    # Strings are decoded on first access, straight from the buffer of the document
+    def __init__(self, view: memoryview, offset: int):
+        _, header_size, _ = struct.unpack_from(_CHUNK_FORMAT_STRING, view, offset)
+        string_count, _, flags, strings_start, _ = struct.unpack_from(_STRING_POOL_FORMAT_STRING, view, offset + _CHUNK_SIZE)
+        self.is_utf8 = flags & _FLAG_UTF8 != 0
+
+        table_offset = offset + header_size
+        self._offsets = array('I')
+        self._offsets.frombytes(view[table_offset:table_offset + string_count * 4])
+        if sys.byteorder != 'little':
+            self._offsets.byteswap()
+        self._view = view
+        self._strings_offset = offset + strings_start
+        self._cache: list[str | None] = [None] * string_count
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, idx: int) -> str:
+        if (string := self._cache[idx]) is not None:
+            return string
+
+        view = self._view
+        offset = self._strings_offset + self._offsets[idx]
+        if self.is_utf8:
+            # Length in utf-16 units then length in bytes, each one byte or two with the high bit set
+            offset += 2 if view[offset] & 0x80 else 1
+            length = view[offset]
+            if length & 0x80:
+                length = (length & 0x7f) << 8 | view[offset + 1]
+                offset += 1
+            offset += 1
+            string = str(view[offset:offset + length], 'utf-8', 'replace')
+        else:
+            length, = struct.unpack_from('<H', view, offset)
+            offset += 2
+            if length & 0x8000:
+                length = (length & 0x7fff) << 16 | struct.unpack_from('<H', view, offset)[0]
+                offset += 2
+            string = str(view[offset:offset + length * 2], 'utf-16-le', 'replace')
+        self._cache[idx] = string
+        return string
+
+    def get(self, idx: int):
+        return None if idx == _NO_INDEX else self[idx]
+
+
+class Element:
+    def __init__(self, name: str, parent: 'Element | None'):
+        self.name = name
+        self.parent = parent
+        self.attributes: dict[str, str | int | float | bool] = {}
+        self.children: list[Element] = []
+
+    def find(self, name: str):
+        return next(self.iter(name), None)
+
+    def iter(self, name: str = None):
+        # Descendants in document order
+        for child in self.children:
+            if name is None or child.name == name:
+                yield child
+            yield from child.iter(name)
+
+
+class AxmlDocument:
+    def __init__(self, data: bytes):
+        view = memoryview(data)
+        chunk_type, header_size, size = struct.unpack_from(_CHUNK_FORMAT_STRING, view)
+        if chunk_type != _TYPE_XML:
+            raise ValueError('Invalid binary xml')
+        self.strings: StringPool | None = None
+        self.root: Element | None = None
+
+        # Namespace uri to prefix, both as string indexes
+        namespaces: dict[int, int] = {}
+        current = None
+        offset = header_size
+        end = min(size, len(view))
+        while offset + _CHUNK_SIZE <= end:
+            chunk_type, header_size, chunk_size = struct.unpack_from(_CHUNK_FORMAT_STRING, view, offset)
+            if chunk_size < _CHUNK_SIZE:
+                raise ValueError(f'Invalid chunk size at {offset}')
+            if chunk_type == _TYPE_STRING_POOL:
+                self.strings = StringPool(view, offset)
+            elif chunk_type == _TYPE_START_NAMESPACE:
+                _, _, prefix, uri = struct.unpack_from(_NAMESPACE_FORMAT_STRING, view, offset + _CHUNK_SIZE)
+                namespaces[uri] = prefix
+            elif chunk_type == _TYPE_START_TAG:
+                element = self._read_element(view, offset, namespaces, current)
+                if current:
+                    current.children.append(element)
+                elif self.root is None:
+                    self.root = element
+                current = element
+            elif chunk_type == _TYPE_END_TAG and current:
+                current = current.parent
+            offset += chunk_size
+
+    def _read_element(self, view: memoryview, offset: int, namespaces: dict[int, int], parent: Element | None):
+        (_, _, _, name, attribute_start, attribute_size, attribute_count, _, _, _) = \
+            struct.unpack_from(_START_TAG_FORMAT_STRING, view, offset + _CHUNK_SIZE)
+        element = Element(self.strings[name], parent)
+
+        attributes_offset = offset + _NODE_HEADER_SIZE + attribute_start
+        if attribute_size == _ATTRIBUTE_SIZE:
+            records = struct.iter_unpack(_ATTRIBUTE_FORMAT_STRING, view[attributes_offset:attributes_offset + attribute_count * _ATTRIBUTE_SIZE])
+        else:
+            records = (struct.unpack_from(_ATTRIBUTE_FORMAT_STRING, view, attributes_offset + i * attribute_size) for i in range(attribute_count))
+
+        strings = self.strings
+        for namespace_uri, name, raw_value, _, _, data_type, data in records:
+            if data_type in (DATA_TYPE_REFERENCE, DATA_TYPE_ATTRIBUTE):
+                value = ResourceReference(data)
+            elif data_type == DATA_TYPE_STRING:
+                value = strings.get(raw_value if raw_value != _NO_INDEX else data)
+            elif data_type == DATA_TYPE_FLOAT:
+                value, = struct.unpack('<f', struct.pack('<I', data))
+            elif data_type == DATA_TYPE_INT_DEC:
+                value = data - (1 << 32) if data & 0x80000000 else data
+            elif data_type == DATA_TYPE_BOOLEAN:
+                value = data != 0
+            else:
+                value = data
+
+            key = strings[name]
+            if (prefix := namespaces.get(namespace_uri)) is not None:
+                key = f'{strings[prefix]}:{key}'
+            element.attributes[key] = value
+        return element
 
 
 class ManifestXml:
     def __init__(self, data: bytes):
+        self.document = AxmlDocument(data)
         self.attributes = {}
 
-        with BytesIO(data) as f:
-            f.seek(Chunk.SIZE)
-            self.string_chunk = StringChunk(f)
-            self._string_cache = {}
-
-            # Skip resource map chunk
-            f.seek(Chunk(f).size - Chunk.SIZE, os.SEEK_CUR)
-
-            self.start_namespace_chunk = StartNamespaceChunk(f)
-            self._namespace_map = {self.start_namespace_chunk.uri: self.start_namespace_chunk.prefix}
-
-            length = len(data)
-            while f.tell() < length:
-                chunk = Chunk(f)
-                if chunk.type != StartTagChunk.TYPE:
-                    f.seek(chunk.size - Chunk.SIZE, os.SEEK_CUR)
-                    continue
-
-                f.seek(-Chunk.SIZE, os.SEEK_CUR)
-                chunk = StartTagChunk(f)
-                name = self._get_string(chunk.name)
-                # Only parse these elements because we need their attributes
-                if name not in ('manifest', 'uses-sdk', 'application'):
-                    # Skip attributes of start tag
-                    f.seek(chunk.attribute_count * StartTagChunk.Attribute.SIZE, os.SEEK_CUR)
-                    continue
-
-                attributes = chunk.read_attribute(f)
-                self._parse_attribute(name, attributes)
-
-    def _parse_attribute(self, name: str, attributes: list[StartTagChunk.Attribute]):
-        match name:
-            case 'manifest':
-                pass
-            case _:
-                self.attributes[name] = {}
-
-        for attribute in attributes:
-            # resources.arsc not parsed
-            if attribute.data_type == StartTagChunk.Attribute.DATA_TYPE_REFERENCE:
-                continue
-
-            prefix = self._get_prefix(attribute.namespace_uri)
-            match attribute.data_type:
-                case StartTagChunk.Attribute.DATA_TYPE_STRING:
-                    attribute.data = self._get_string(attribute.data)
-                case StartTagChunk.Attribute.DATA_TYPE_BOOLEAN:
-                    attribute.data = attribute.data != 0
-
-            key = f'{prefix}{self._get_string(attribute.name)}'
-            match name:
-                case 'manifest':
-                    self.attributes[key] = attribute.data
-                case _:
-                    self.attributes[name][key] = attribute.data
-
-    def _get_string(self, idx: int):
-        if idx in self._string_cache:
-            return self._string_cache[idx]
-
-        offset = self.string_chunk.string_offsets[idx]
-        chars_start = offset + 2
-        if self.string_chunk.is_utf8:
-            struct_size = 1  # Skip byte length
-            format_string = '<B'
-            encoding = 'utf-8'
-        else:
-            struct_size = 2
-            format_string = '<H'
-            encoding = 'utf-16'
-        char_num = struct.unpack(format_string, self.string_chunk.string_pool[offset: offset + struct_size])[0]
-        chars = self.string_chunk.string_pool[chars_start: chars_start + char_num * struct_size].decode(encoding)
-        self._string_cache[idx] = chars
-        return chars
-
-    def _get_prefix(self, uri: int):
-        if uri == 0xFFFFFFFF:
-            return ''
-        return f'{self._get_string(self._namespace_map[uri])}:'
+        # Attributes of manifest at the top level, and of the elements below that we need
+        root = self.document.root
+        self.attributes.update(_literal_attributes(root))
+        for element in root.iter():
+            if element.name in ('uses-sdk', 'application'):
+                self.attributes[element.name] = _literal_attributes(element)
+
+
+def _literal_attributes(element: Element):
+    return {x: value for x, value in element.attributes.items() if not isinstance(value, ResourceReference)}
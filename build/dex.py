@@ -0,0 +1,297 @@
+import hashlib
+import struct
+import zlib
+from zipfile import ZipFile
+
+from .smali import MethodSpecifier
+
+_MAGIC = b'dex\n'
+# @formatter:off
+_HEADER_FORMAT_STRING = ('<8s'   # magic
+                         'I'     # checksum
+                         '20s'   # signature
+                         'I'     # file size
+                         'I'     # header size
+                         'I'     # endian tag
+                         'I'     # link size
+                         'I'     # link offset
+                         'I'     # map offset
+                         'I'     # string ids size
+                         'I'     # string ids offset
+                         'I'     # type ids size
+                         'I'     # type ids offset
+                         'I'     # proto ids size
+                         'I'     # proto ids offset
+                         'I'     # field ids size
+                         'I'     # field ids offset
+                         'I'     # method ids size
+                         'I'     # method ids offset
+                         'I'     # class defs size
+                         'I'     # class defs offset
+                         'I'     # data size
+                         'I')    # data offset
+# @formatter:on
+_CLASS_DEF_SIZE = 32
+_CODE_ITEM_HEADER_SIZE = 16
+_ACC_PUBLIC = 0x1
+_ACC_PRIVATE = 0x2
+_ACC_PROTECTED = 0x4
+_ACC_STATIC = 0x8
+_ACC_FINAL = 0x10
+_ACC_ABSTRACT = 0x400
+_ACC_CONSTRUCTOR = 0x10000
+# @formatter:off
+_NOP = 0x00
+_RETURN_VOID = 0x0e
+_RETURN = 0x0f
+_RETURN_OBJECT = 0x11
+_CONST_4 = 0x12
+_CONST_16 = 0x13
+_CONST = 0x14
+# @formatter:on
+
+
+def is_dex_entry(name: str):
+    return name.startswith('classes') and name.endswith('.dex') and (name[len('classes'):-len('.dex')].isdigit() or name == 'classes.dex')
+
+
+def dex_index(name: str):
+    return int(name[len('classes'):-len('.dex')] or 1)
+
+
+def class_descriptors(data: bytes) -> list[str]:
+    header = struct.unpack_from(_HEADER_FORMAT_STRING, data)
+    if header[0][:4] != _MAGIC:
+        raise ValueError('Invalid dex magic')
+    string_ids_offset, type_ids_offset = header[10], header[12]
+    class_defs_size, class_defs_offset = header[19], header[20]
+
+    descriptors = []
+    for i in range(class_defs_size):
+        class_idx, = struct.unpack_from('<I', data, class_defs_offset + i * _CLASS_DEF_SIZE)
+        descriptor_idx, = struct.unpack_from('<I', data, type_ids_offset + class_idx * 4)
+        descriptors.append(read_string(data, string_ids_offset, descriptor_idx))
+    return descriptors
+
+
+def read_string(data: bytes, string_ids_offset: int, index: int):
+    string_data_offset, = struct.unpack_from('<I', data, string_ids_offset + index * 4)
+    # Skip the utf-16 length, the MUTF-8 data is terminated by a null byte
+    _, offset = read_uleb128(data, string_data_offset)
+    return data[offset:data.index(b'\0', offset)].decode('utf-8', 'surrogateescape')
+
+
+def read_sleb128(data: bytes, offset: int):
+    result, end = read_uleb128(data, offset)
+    bits = (end - offset) * 7
+    if result & (1 << (bits - 1)):
+        result -= 1 << bits
+    return result, end
+
+
+def read_uleb128(data: bytes, offset: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def class_map(file: str) -> dict[str, str]:
+    # Map each class descriptor to the dex entry that defines it, the first dex wins like the class loader does
+    results = {}
+    with ZipFile(file, 'r') as zip_file:
+        for name in sorted(filter(is_dex_entry, zip_file.namelist()), key=dex_index, reverse=True):
+            results.update(dict.fromkeys(class_descriptors(zip_file.read(name)), name))
+    return results
+
+
+class DexFile:
+    # Patches methods into stubs directly in the bytecode, for edits that do not need a smali round trip
+    def __init__(self, data: bytes):
+        self._data = bytearray(data)
+        header = struct.unpack_from(_HEADER_FORMAT_STRING, self._data)
+        if header[0][:4] != _MAGIC:
+            raise ValueError('Invalid dex magic')
+        self._string_ids_offset = header[10]
+        self._type_ids_offset = header[12]
+        self._proto_ids_offset = header[14]
+        self._method_ids_offset = header[18]
+        self._class_defs_size = header[19]
+        self._class_defs_offset = header[20]
+        self._modified = False
+
+    def is_modified(self):
+        return self._modified
+
+    def to_bytes(self):
+        if self._modified:
+            self._data[12:32] = hashlib.sha1(self._data[32:]).digest()
+            struct.pack_into('<I', self._data, 8, zlib.adler32(self._data[12:]))
+        return bytes(self._data)
+
+    def method_nop(self, descriptor: str, specifier: MethodSpecifier):
+        self._replace_code(descriptor, specifier, [[_RETURN_VOID]], 0)
+
+    def method_return_boolean(self, descriptor: str, specifier: MethodSpecifier, value: bool):
+        self.method_return_int(descriptor, specifier, int(value))
+
+    def method_return_int(self, descriptor: str, specifier: MethodSpecifier, value: int):
+        if -8 <= value < 8:
+            const_instruction = [_CONST_4 | (value & 0xf) << 12]
+        elif -32768 <= value < 32768:
+            const_instruction = [_CONST_16, value & 0xffff]
+        else:
+            const_instruction = [_CONST, value & 0xffff, value >> 16 & 0xffff]
+        self._replace_code(descriptor, specifier, [const_instruction, [_RETURN]], 1)
+
+    def method_return_null(self, descriptor: str, specifier: MethodSpecifier):
+        self._replace_code(descriptor, specifier, [[_CONST_4], [_RETURN_OBJECT]], 1)
+
+    def _replace_code(self, descriptor: str, specifier: MethodSpecifier, stub: list[list[int]], registers: int):
+        code_offset = self._find_method(descriptor, specifier)
+        registers_size, ins_size, outs_size, tries_size, debug_info_offset, insns_size = \
+            struct.unpack_from('<HHHHII', self._data, code_offset)
+        stub_size = sum(len(x) for x in stub)
+        if insns_size < stub_size:
+            raise ValueError(f'Method is too short for the stub: {descriptor}->{specifier.name}')
+
+        # The code item keeps its size, the stub sits at the end of a nop slide so that the try blocks and handlers
+        # still point to instruction boundaries and no path runs off the end of the method
+        start = insns_size - stub_size
+        inner_addresses = set()
+        address = start
+        for instruction in stub:
+            inner_addresses.update(range(address + 1, address + len(instruction)))
+            address += len(instruction)
+        if not inner_addresses.isdisjoint(self._code_addresses(code_offset, insns_size, tries_size)):
+            raise ValueError(f'Stub overlaps a try block or handler: {descriptor}->{specifier.name}')
+
+        units = [_NOP] * start + [unit for instruction in stub for unit in instruction]
+        struct.pack_into(f'<HHHHII{insns_size}H', self._data, code_offset,
+                         max(registers_size, registers), ins_size, outs_size, tries_size, debug_info_offset, insns_size, *units)
+        self._modified = True
+
+    def _code_addresses(self, code_offset: int, insns_size: int, tries_size: int):
+        # Start and end addresses of the try blocks, and start addresses of their handlers
+        addresses = set()
+        if tries_size == 0:
+            return addresses
+        tries_offset = code_offset + _CODE_ITEM_HEADER_SIZE + insns_size * 2 + insns_size % 2 * 2
+        for i in range(tries_size):
+            start_address, insn_count, _ = struct.unpack_from('<IHH', self._data, tries_offset + i * 8)
+            addresses.add(start_address)
+            addresses.add(start_address + insn_count)
+
+        offset = tries_offset + tries_size * 8
+        handlers_size, offset = read_uleb128(self._data, offset)
+        for _ in range(handlers_size):
+            size, offset = read_sleb128(self._data, offset)
+            for _ in range(abs(size)):
+                _, offset = read_uleb128(self._data, offset)
+                address, offset = read_uleb128(self._data, offset)
+                addresses.add(address)
+            if size <= 0:
+                address, offset = read_uleb128(self._data, offset)
+                addresses.add(address)
+        return addresses
+
+    def _find_method(self, descriptor: str, specifier: MethodSpecifier):
+        if specifier.keywords:
+            raise ValueError('Keywords can not be matched in dex')
+        class_data_offset = self._class_data_offset(descriptor)
+
+        results = []
+        offset = class_data_offset
+        static_fields_size, offset = read_uleb128(self._data, offset)
+        instance_fields_size, offset = read_uleb128(self._data, offset)
+        direct_methods_size, offset = read_uleb128(self._data, offset)
+        virtual_methods_size, offset = read_uleb128(self._data, offset)
+        for _ in range((static_fields_size + instance_fields_size) * 2):
+            _, offset = read_uleb128(self._data, offset)
+        for count in (direct_methods_size, virtual_methods_size):
+            method_idx = 0
+            for _ in range(count):
+                method_idx_diff, offset = read_uleb128(self._data, offset)
+                access_flags, offset = read_uleb128(self._data, offset)
+                code_offset, offset = read_uleb128(self._data, offset)
+                method_idx += method_idx_diff
+                if code_offset and not access_flags & _ACC_CONSTRUCTOR and self._match(specifier, method_idx, access_flags):
+                    results.append(code_offset)
+
+        if len(results) != 1:
+            raise ValueError(f'Found {len(results)} methods matching {descriptor}->{specifier.name}')
+        return results[0]
+
+    def _match(self, specifier: MethodSpecifier, method_idx: int, access_flags: int):
+        _, proto_idx, name_idx = struct.unpack_from('<HHI', self._data, self._method_ids_offset + method_idx * 8)
+        if specifier.name is not None and self._string(name_idx) != specifier.name:
+            return False
+        if specifier.access is not None:
+            if access_flags & _ACC_PUBLIC:
+                access = MethodSpecifier.Access.PUBLIC
+            elif access_flags & _ACC_PROTECTED:
+                access = MethodSpecifier.Access.PROTECTED
+            elif access_flags & _ACC_PRIVATE:
+                access = MethodSpecifier.Access.PRIVATE
+            else:
+                access = MethodSpecifier.Access.DEFAULT
+            if access != specifier.access:
+                return False
+        for expected, flag in ((specifier.is_static, _ACC_STATIC), (specifier.is_final, _ACC_FINAL), (specifier.is_abstract, _ACC_ABSTRACT)):
+            if expected is not None and expected != bool(access_flags & flag):
+                return False
+
+        _, return_type_idx, parameters_offset = struct.unpack_from('<III', self._data, self._proto_ids_offset + proto_idx * 12)
+        if specifier.return_type is not None and self._type(return_type_idx) != specifier.return_type:
+            return False
+        if specifier.parameters is not None:
+            parameters = ''
+            if parameters_offset:
+                size, = struct.unpack_from('<I', self._data, parameters_offset)
+                type_indexes = struct.unpack_from(f'<{size}H', self._data, parameters_offset + 4)
+                parameters = ''.join(self._type(x) for x in type_indexes)
+            if parameters != specifier.parameters:
+                return False
+        return True
+
+    def _class_data_offset(self, descriptor: str):
+        for i in range(self._class_defs_size):
+            class_def_offset = self._class_defs_offset + i * _CLASS_DEF_SIZE
+            class_idx, = struct.unpack_from('<I', self._data, class_def_offset)
+            if self._type(class_idx) == descriptor:
+                class_data_offset, = struct.unpack_from('<I', self._data, class_def_offset + 24)
+                if class_data_offset == 0:
+                    raise ValueError(f'Class has no methods: {descriptor}')
+                return class_data_offset
+        raise ValueError(f'Class not found: {descriptor}')
+
+    def _type(self, type_idx: int):
+        descriptor_idx, = struct.unpack_from('<I', self._data, self._type_ids_offset + type_idx * 4)
+        return self._string(descriptor_idx)
+
+    def _string(self, string_idx: int):
+        return read_string(self._data, self._string_ids_offset, string_idx)
+
+
+class DexClass:
+    # Same stub methods as SmaliFile, applied to one class of a dex
+    def __init__(self, dex_file: DexFile, descriptor: str):
+        self.dex_file = dex_file
+        self.descriptor = descriptor
+
+    def method_nop(self, specifier: MethodSpecifier):
+        self.dex_file.method_nop(self.descriptor, specifier)
+
+    def method_return_boolean(self, specifier: MethodSpecifier, value: bool):
+        self.dex_file.method_return_boolean(self.descriptor, specifier, value)
+
+    def method_return_int(self, specifier: MethodSpecifier, value: int):
+        self.dex_file.method_return_int(self.descriptor, specifier, value)
+
+    def method_return_null(self, specifier: MethodSpecifier):
+        self.dex_file.method_return_null(self.descriptor, specifier)
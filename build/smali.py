@@ -21,57 +21,64 @@ class MethodSpecifier:
 
 
 class SmaliFile:
+    _METHOD_PATTERN = re.compile(r'(\.method (public|protected|private|)(.*?)(\S+)\((\S*?)\)(\S+?)\n.+?\.end method)', re.DOTALL)
+    _MATCH_FIELDS = ('name', 'access', 'is_static', 'is_final', 'is_abstract', 'parameters', 'return_type')
+
     def __init__(self, file: str):
         self.file = file
-        self._methods: dict[MethodSpecifier, str] = {}
-        self._constructors: dict[MethodSpecifier, str] = {}
-
+        self._dirty = False
         with open(self.file, 'r', encoding='utf-8') as f:
-            pattern = re.compile(r'(\.method (public|protected|private|)(.*?)(\S+)\((\S*?)\)(\S+?)\n.+?\.end method)', re.DOTALL)
-            for method_defines in re.findall(pattern, f.read()):
-                if ' constructor ' in method_defines[2]:
-                    self._parse_constructor(method_defines)
-                else:
-                    self._parse_method(method_defines)
+            self._parse(f.read())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+    def commit(self):
+        # All edits are kept in memory until here, the file is written at most once
+        if not self._dirty:
+            return False
+        with open(self.file, 'w', encoding='utf-8') as f:
+            f.write(''.join(self._chunks))
+        self._dirty = False
+        return True
 
     def find_method(self, specifier: MethodSpecifier) -> str | None:
-        results = self._methods.keys()
-        conditions = {
-            lambda x: True if specifier.name is None else x.name == specifier.name,
-            lambda x: True if specifier.access is None else x.access == specifier.access,
-            lambda x: True if specifier.is_static is None else x.is_static == specifier.is_static,
-            lambda x: True if specifier.is_final is None else x.is_final == specifier.is_final,
-            lambda x: True if specifier.is_abstract is None else x.is_abstract == specifier.is_abstract,
-            lambda x: True if specifier.parameters is None else x.parameters == specifier.parameters,
-            lambda x: True if specifier.return_type is None else x.return_type == specifier.return_type
-        }
-        for condition in conditions:
-            results = set(filter(condition, results))
-        if specifier.keywords:
-            results = set(filter(self._filter_keywords(specifier.keywords), results))
+        if specifier.name is not None and specifier.parameters is not None and specifier.return_type is not None:
+            candidates = self._signatures.get((specifier.name, specifier.parameters, specifier.return_type), ())
+        elif specifier.name is not None:
+            candidates = self._names.get(specifier.name, ())
+        else:
+            candidates = self._methods.keys()
 
+        results = [x for x in candidates if self._match(specifier, x)]
         if len(results) == 1:
-            return self._methods[results.pop()]
+            return self._chunks[self._methods[results[0]]]
         else:
             return None
 
     def find_constructor(self, parameters: str = ''):
-        results = self._constructors.keys()
-        results = set(filter(lambda x: x.parameters == parameters, results))
+        results = [x for x in self._constructors.keys() if x.parameters == parameters]
 
         if len(results) == 1:
-            return self._constructors[results.pop()]
+            return self._chunks[self._constructors[results[0]]]
         else:
             return None
 
     def method_replace(self, old_method: str | MethodSpecifier, new_body: str):
         if type(old_method) is MethodSpecifier:
             old_method = self.find_method(old_method)
-        with open(self.file, 'r+', encoding='utf-8') as file:
-            text = file.read().replace(old_method, new_body)
-            file.seek(0)
-            file.truncate()
-            file.write(text)
+        self._dirty = True
+
+        index = next((i for i in (*self._methods.values(), *self._constructors.values()) if self._chunks[i] == old_method), None)
+        if index is not None and new_body.count('.method ') == 1 and new_body.partition('\n')[0] == old_method.partition('\n')[0]:
+            # The declaration is unchanged, only the body needs to be swapped
+            self._chunks[index] = new_body
+        else:
+            self._parse(''.join(self._chunks).replace(old_method, new_body))
 
     def method_return_boolean(self, specifier: MethodSpecifier, value: bool):
         self.method_return_int(specifier, int(value))
@@ -134,7 +141,27 @@ class SmaliFile:
         normpath = self.file.replace('\\', '/')
         return re.sub(r'.+?/smali/classes\d*/(.+?)(?:\.1)*\.smali', r'L\g<1>;', normpath)
 
-    def _parse_method(self, method_defines: tuple[str, ...]):
+    def _parse(self, text: str):
+        self._chunks: list[str] = []
+        self._methods: dict[MethodSpecifier, int] = {}
+        self._constructors: dict[MethodSpecifier, int] = {}
+        self._signatures: dict[tuple[str, str, str], list[MethodSpecifier]] = {}
+        self._names: dict[str, list[MethodSpecifier]] = {}
+
+        position = 0
+        for match in self._METHOD_PATTERN.finditer(text):
+            self._chunks.append(text[position:match.start()])
+            self._chunks.append(match.group(1))
+            position = match.end()
+
+            method_defines = match.groups()
+            if ' constructor ' in method_defines[2]:
+                self._parse_constructor(method_defines, len(self._chunks) - 1)
+            else:
+                self._parse_method(method_defines, len(self._chunks) - 1)
+        self._chunks.append(text[position:])
+
+    def _parse_method(self, method_defines: tuple[str, ...], index: int):
         specifier = MethodSpecifier()
         specifier.access = MethodSpecifier.Access(method_defines[1])
         specifier.is_static = ' static ' in method_defines[2]
@@ -144,17 +171,20 @@ class SmaliFile:
         specifier.parameters = method_defines[4]
         specifier.return_type = method_defines[5]
 
-        self._methods[specifier] = method_defines[0]
+        self._methods[specifier] = index
+        self._signatures.setdefault((specifier.name, specifier.parameters, specifier.return_type), []).append(specifier)
+        self._names.setdefault(specifier.name, []).append(specifier)
 
-    def _parse_constructor(self, method_defines: tuple[str, ...]):
+    def _parse_constructor(self, method_defines: tuple[str, ...], index: int):
         specifier = MethodSpecifier()
         specifier.parameters = method_defines[4]
 
-        self._constructors[specifier] = method_defines[0]
-
-    def _filter_keywords(self, keywords):
-        def condition(specifier: MethodSpecifier):
-            body = self._methods[specifier]
-            return all(x in body for x in keywords)
+        self._constructors[specifier] = index
 
-        return condition
+    def _match(self, specifier: MethodSpecifier, candidate: MethodSpecifier):
+        for field in self._MATCH_FIELDS:
+            value = getattr(specifier, field)
+            if value is not None and getattr(candidate, field) != value:
+                return False
+        body = self._chunks[self._methods[candidate]]
+        return all(x in body for x in specifier.keywords)
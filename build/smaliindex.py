@@ -0,0 +1,104 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from glob import iglob
+
+import config
+
+# String constants and class references, a keyword inside one of them never crosses its bounds
+_TOKEN_PATTERN = re.compile(rb'"(?:[^"\\\n]|\\.)*"|L[^;\s"]+;')
+_BATCH_SIZE = 500
+_PARALLEL_THRESHOLD = 2000
+
+
+class SmaliIndex:
+    def __init__(self, smali_dir: str):
+        self._smali_dir = smali_dir
+        self._files: list[str] = []
+        self._class_paths: list[str] = []
+        self._file_ids: dict[str, int] = {}
+        self._postings: dict[bytes, set[int]] = {}
+        self._candidates: dict[bytes, set[int]] = {}
+
+        files = list(iglob(f'{smali_dir}/classes*/**/*.smali', recursive=True))
+        if len(files) >= _PARALLEL_THRESHOLD and config.SMALI_INDEX_JOBS > 1:
+            batches = [files[i:i + _BATCH_SIZE] for i in range(0, len(files), _BATCH_SIZE)]
+            with ProcessPoolExecutor(config.SMALI_INDEX_JOBS) as executor:
+                for result in executor.map(_scan, batches):
+                    for file, tokens in result:
+                        self._add(file, tokens)
+        else:
+            for file, tokens in _scan(files):
+                self._add(file, tokens)
+
+    def update(self, file: str):
+        # Postings of the old content are kept, stale candidates are dropped by the verification in search
+        for file, tokens in _scan([file]):
+            self._add(file, tokens)
+        self._candidates.clear()
+
+    def search(self, queries: tuple[tuple[str, ...], ...], package: str = None) -> list[list[str]]:
+        package_prefix = f'{package}/' if package else ''
+        encoded_queries = []
+        candidates_list = []
+        for keywords in queries:
+            encoded = [x.encode('utf-8') for x in keywords]
+            candidates = None
+            for keyword, encoded_keyword in zip(keywords, encoded):
+                if _is_token_bounded(keyword):
+                    found = self._find_candidates(encoded_keyword)
+                    candidates = found if candidates is None else candidates & found
+            if candidates is None:
+                candidates = set(range(len(self._files)))
+            if package_prefix:
+                candidates = {x for x in candidates if self._class_paths[x].startswith(package_prefix)}
+            encoded_queries.append(encoded)
+            candidates_list.append(candidates)
+
+        # Each candidate file is read once and verified against all queries that selected it
+        results = [[] for _ in queries]
+        for file_id in sorted(set().union(*candidates_list)):
+            with open(self._files[file_id], 'rb') as f:
+                data = f.read()
+            for result, encoded, candidates in zip(results, encoded_queries, candidates_list):
+                if file_id in candidates and all(x in data for x in encoded):
+                    result.append(self._files[file_id])
+        return results
+
+    def _find_candidates(self, keyword: bytes):
+        if keyword not in self._candidates:
+            candidates = set()
+            for token, file_ids in self._postings.items():
+                if keyword in token:
+                    candidates |= file_ids
+            self._candidates[keyword] = candidates
+        return self._candidates[keyword]
+
+    def _add(self, file: str, tokens: set[bytes]):
+        key = os.path.normcase(os.path.abspath(file))
+        if (file_id := self._file_ids.get(key)) is None:
+            file_id = len(self._files)
+            self._file_ids[key] = file_id
+            self._files.append(file)
+            class_path = os.path.relpath(file, self._smali_dir).replace('\\', '/')
+            self._class_paths.append(class_path.partition('/')[2])
+        for token in tokens:
+            self._postings.setdefault(token, set()).add(file_id)
+
+
+def _scan(files: list[str]):
+    results = []
+    for file in files:
+        with open(file, 'rb') as f:
+            results.append((file, set(_TOKEN_PATTERN.findall(f.read()))))
+    return results
+
+
+def _is_token_bounded(keyword: str):
+    # A keyword that opens a string constant ends inside it unless it contains another quote,
+    # and the same holds for a class reference ended by its semicolon
+    if len(keyword) >= 2 and keyword[0] == '"' and keyword[1] not in ' ,}\r\n':
+        return '"' not in keyword[1:-1]
+    if len(keyword) >= 2 and keyword[0] == 'L' and keyword[-1] == ';':
+        return not any(x in keyword[:-1] for x in ' \t\r\n";')
+    return False
@@ -1,10 +1,16 @@
+import os
+import re
+import shutil
 import xml.etree.ElementTree as eTree
+import xml.parsers.expat as expat
 from xml.etree.ElementTree import Element
 
 _NAMESPACES = {
     'android': 'http://schemas.android.com/apk/res/android',
     'app': 'http://schemas.android.com/apk/res-auto'
 }
+_SELECTOR_PATTERN = re.compile(r'([^\[\]\s]+)(?:\[@([^=\]\s]+)="([^"]*)"])?')
+_STREAM_BUFFER_SIZE = 1024 * 1024
 
 
 class XmlFile:
@@ -28,3 +34,105 @@ class XmlFile:
             if k == splits[0]:
                 return f'{{{v}}}{splits[1]}'
         return None
+
+
+def remove_elements(file: str, *selectors: str):
+    # Elements are cut out of the raw bytes while the file streams through expat, so a large file is never loaded as a tree
+    # and everything else, comments and formatting included, is kept as it is. Selectors look like tag[@attr="value"]
+    matchers = []
+    for selector in selectors:
+        if not (match := _SELECTOR_PATTERN.fullmatch(selector)):
+            raise ValueError(f'Unsupported selector: {selector}')
+        matchers.append(match.groups())
+
+    cutter = _ElementCutter(matchers)
+    with open(file, 'rb') as f:
+        while data := f.read(_STREAM_BUFFER_SIZE):
+            cutter.parser.Parse(data, False)
+        cutter.parser.Parse(b'', True)
+    if missing := [x for x, matcher in zip(selectors, matchers) if matcher not in cutter.found]:
+        raise ValueError(f'Element not found in {file}: {', '.join(missing)}')
+
+    tmp_file = f'{file}.tmp'
+    with open(file, 'rb') as src, open(tmp_file, 'wb') as dst:
+        position = 0
+        for start, end in _expand_lines(src, cutter.ranges):
+            _copy(src, dst, position, start)
+            position = end
+        _copy(src, dst, position)
+    shutil.copymode(file, tmp_file)
+    os.replace(tmp_file, file)
+
+
+class _ElementCutter:
+    def __init__(self, matchers: list[tuple[str, str | None, str | None]]):
+        self.parser = expat.ParserCreate()
+        self.ranges: list[tuple[int, int]] = []
+        self.found = set()
+        self._matchers = matchers
+        self._depth = 0
+        self._cut_depth = None
+        self._cut_start = None
+        self._pending_end = False
+
+        # The end index of an element is only known at the next event, end tags report their own start
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._event
+        self.parser.CommentHandler = self._event
+        self.parser.DefaultHandler = self._event
+
+    def _start(self, name: str, attributes: dict[str, str]):
+        self._event()
+        self._depth += 1
+        if self._cut_depth is not None:
+            return
+        for matcher in self._matchers:
+            tag, key, value = matcher
+            if name == tag and (key is None or attributes.get(key) == value):
+                self.found.add(matcher)
+                self._cut_depth = self._depth
+                self._cut_start = self.parser.CurrentByteIndex
+                break
+
+    def _end(self, _):
+        self._event()
+        if self._cut_depth == self._depth:
+            self._pending_end = True
+            self._cut_depth = None
+        self._depth -= 1
+
+    def _event(self, *_):
+        if self._pending_end:
+            self.ranges.append((self._cut_start, self.parser.CurrentByteIndex))
+            self._pending_end = False
+
+
+def _expand_lines(f, ranges: list[tuple[int, int]]):
+    # An element on a line of its own takes its indentation and line break along
+    for start, end in ranges:
+        window_start = max(start - 256, 0)
+        f.seek(window_start)
+        before = f.read(start - window_start)
+        f.seek(end)
+        after = f.read(2)
+        indentation = len(before) - len(before.rstrip(b' \t'))
+        line_start = start - indentation
+        if line_start == 0 or line_start > window_start and before[line_start - window_start - 1] == ord('\n'):
+            line_break = 2 if after.startswith(b'\r\n') else 1 if after.startswith(b'\n') else 0
+            if line_break:
+                start -= indentation
+                end += line_break
+        yield start, end
+
+
+def _copy(src, dst, start: int, end: int = None):
+    src.seek(start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        data = src.read(_STREAM_BUFFER_SIZE if remaining is None else min(remaining, _STREAM_BUFFER_SIZE))
+        if not data:
+            break
+        dst.write(data)
+        if remaining is not None:
+            remaining -= len(data)
@@ -0,0 +1,135 @@
+import struct
+import zlib
+from typing import BinaryIO
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipInfo
+
+_ALIGNMENT = 4
+# Stored native libraries are mapped straight from the apk, they are aligned to 16 KB pages like zipalign -P 16 does
+_SO_ALIGNMENT = 16384
+_ALIGNMENT_EXTRA_ID = 0xd935
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_ZIP64_LIMIT = 0xffffffff
+_COPY_BUFFER_SIZE = 1024 * 1024
+# @formatter:off
+_LOCAL_HEADER_FORMAT_STRING = ('<4s'  # signature
+                               'H'    # version needed to extract
+                               'H'    # flags
+                               'H'    # compression method
+                               'H'    # last modified time
+                               'H'    # last modified date
+                               'I'    # crc-32
+                               'I'    # compressed size
+                               'I'    # uncompressed size
+                               'H'    # file name length
+                               'H')   # extra field length
+_CENTRAL_HEADER_FORMAT_STRING = ('<4s'  # signature
+                                 'B'    # version made by
+                                 'B'    # host system
+                                 'H'    # version needed to extract
+                                 'H'    # flags
+                                 'H'    # compression method
+                                 'H'    # last modified time
+                                 'H'    # last modified date
+                                 'I'    # crc-32
+                                 'I'    # compressed size
+                                 'I'    # uncompressed size
+                                 'H'    # file name length
+                                 'H'    # extra field length
+                                 'H'    # file comment length
+                                 'H'    # disk number start
+                                 'H'    # internal file attributes
+                                 'I'    # external file attributes
+                                 'I')   # local header offset
+_END_FORMAT_STRING = ('<4s'  # signature
+                      'H'    # number of this disk
+                      'H'    # disk where central directory starts
+                      'H'    # number of central directory records on this disk
+                      'H'    # total number of central directory records
+                      'I'    # size of central directory
+                      'I'    # offset of central directory
+                      'H')   # comment length
+# @formatter:on
+
+
+class ZipRepacker:
+    # Writes a new archive from entries of existing ones, copied entries keep their compressed bytes untouched
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self._entries: list[tuple[ZipInfo, int, int, int, int]] = []
+
+    def copy(self, source: BinaryIO, info: ZipInfo):
+        source.seek(info.header_offset)
+        header = struct.unpack(_LOCAL_HEADER_FORMAT_STRING, source.read(struct.calcsize(_LOCAL_HEADER_FORMAT_STRING)))
+        source.seek(header[9] + header[10], 1)
+
+        self._write_local_header(info, info.CRC, info.compress_size, info.file_size)
+        remaining = info.compress_size
+        while remaining > 0:
+            data = source.read(min(remaining, _COPY_BUFFER_SIZE))
+            if not data:
+                raise EOFError(f'Truncated zip entry: {info.filename}')
+            self._file.write(data)
+            remaining -= len(data)
+
+    def write(self, info: ZipInfo, data: bytes):
+        match info.compress_type:
+            case 0:
+                compressed = data
+            case 8:
+                compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+                compressed = compressor.compress(data) + compressor.flush()
+            case _:
+                raise ValueError(f'Unsupported compression method: {info.compress_type}')
+        self._write_local_header(info, zlib.crc32(data), len(compressed), len(data))
+        self._file.write(compressed)
+
+    def close(self, comment: bytes = b''):
+        central_offset = self._file.tell()
+        for info, offset, crc, compressed_size, size in self._entries:
+            name, flags = _encode_name(info)
+            self._file.write(struct.pack(_CENTRAL_HEADER_FORMAT_STRING, b'PK\1\2', info.create_version, info.create_system,
+                                         _extract_version(info), flags, info.compress_type, *_dos_time(info), crc, compressed_size, size,
+                                         len(name), 0, 0, 0, info.internal_attr, info.external_attr, offset))
+            self._file.write(name)
+        central_size = self._file.tell() - central_offset
+        self._file.write(struct.pack(_END_FORMAT_STRING, b'PK\5\6', 0, 0, len(self._entries), len(self._entries),
+                                     central_size, central_offset, len(comment)))
+        self._file.write(comment)
+
+    def _write_local_header(self, info: ZipInfo, crc: int, compressed_size: int, size: int):
+        offset = self._file.tell()
+        if max(offset, compressed_size, size) >= _ZIP64_LIMIT:
+            raise ValueError(f'ZIP64 is not supported: {info.filename}')
+        name, flags = _encode_name(info)
+
+        extra = b''
+        if info.compress_type == ZIP_STORED:
+            # Stored entries are aligned like zipalign does, so that they can be mapped directly
+            alignment = _SO_ALIGNMENT if info.filename.startswith('lib/') and info.filename.endswith('.so') else _ALIGNMENT
+            data_offset = offset + struct.calcsize(_LOCAL_HEADER_FORMAT_STRING) + len(name) + 6
+            padding = -data_offset % alignment
+            extra = struct.pack('<HHH', _ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+
+        self._file.write(struct.pack(_LOCAL_HEADER_FORMAT_STRING, b'PK\3\4', _extract_version(info), flags, info.compress_type, *_dos_time(info),
+                                     crc, compressed_size, size, len(name), len(extra)))
+        self._file.write(name)
+        self._file.write(extra)
+        self._entries.append((info, offset, crc, compressed_size, size))
+
+
+def _encode_name(info: ZipInfo):
+    flags = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    try:
+        return info.filename.encode('ascii'), flags & ~_FLAG_UTF8
+    except UnicodeEncodeError:
+        return info.filename.encode('utf-8'), flags | _FLAG_UTF8
+
+
+def _extract_version(info: ZipInfo):
+    return max(info.extract_version, 20 if info.compress_type == ZIP_DEFLATED else 10)
+
+
+def _dos_time(info: ZipInfo):
+    year, month, day, hour, minute, second = info.date_time
+    return hour << 11 | minute << 5 | second // 2, (year - 1980) << 9 | month << 5 | day
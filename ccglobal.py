@@ -1,8 +1,12 @@
+import io
 import sys
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 LIB_DIR = f'{sys.path[0]}/lib'
 MISC_DIR = f'{sys.path[0]}/misc'
+CACHE_DIR = f'{sys.path[0]}/cache'
 PARTITION_FILESYSTEM_JSON = 'config/partition_filesystem.json'
 UPDATED_APP_JSON = 'product/UpdatedApp.json'
 
@@ -12,10 +16,36 @@ sdk: int
 kmi: str
 patch_number: int
 
+_log_lock = threading.Lock()
+_log_local = threading.local()
+
 
 def log(string: str):
     now = datetime.now().strftime('[%m-%d %H:%M:%S]')
-    print(f'{now} {string}')
+    write_log(f'{now} {string}\n')
+
+
+def write_log(text: str):
+    buffer = getattr(_log_local, 'buffer', None)
+    if buffer is not None:
+        buffer.write(text)
+        return
+    with _log_lock:
+        print(text, end='', flush=True)
+
+
+def is_log_buffered():
+    return getattr(_log_local, 'buffer', None) is not None
+
+
+@contextmanager
+def buffered_log(buffer: io.StringIO):
+    # Hold the logs of current thread, so that the output of parallel tasks does not interleave
+    _log_local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        _log_local.buffer = None
 
 
 def get_prop_value(prop: str):
@@ -2,6 +2,32 @@ SUPER_SIZE = 15354134528
 SUPER_PARTITIONS = ('system', 'system_ext', 'system_dlkm', 'product', 'vendor', 'vendor_dlkm', 'odm',
                     'my_bigball', 'my_carrier', 'my_company', 'my_engineering', 'my_heytap', 'my_manifest', 'my_preload', 'my_product', 'my_region', 'my_stock')
 UNPACK_PARTITIONS = ('boot', 'system', 'system_ext', 'product', 'vendor', 'my_manifest', 'my_product', 'my_stock')
+REPACK_JOBS = 4
+# Partitions that are only passed through are extracted in background, with this many of the jobs
+PASSTHROUGH_EXTRACT_JOBS = 2
+# mkfs.erofs compression options, the partitions listed below use their own instead of the default
+EROFS_COMPRESSION = ('-zlz4hc,1',)
+EROFS_PARTITION_COMPRESSION = {}
+# Profiles compared by the benchmark command
+EROFS_BENCHMARK_PROFILES = {
+    'lz4': ('-zlz4',),
+    'lz4hc-1': ('-zlz4hc,1',),
+    'lz4hc-9': ('-zlz4hc,9',),
+    'lz4hc-9-64k': ('-zlz4hc,9', '-C65536'),
+    'lz4hc-9-dedupe': ('-zlz4hc,9', '-Ededupe'),
+    'lz4hc-9-fragments': ('-zlz4hc,9', '-Efragments'),
+}
+# Write super.img with lpmake and compress it afterwards, instead of streaming it straight into zstd
+SUPER_LPMAKE = False
+# Images outside super are compared with the device in blocks of this size, only the blocks that differ are written
+FLASH_BLOCK_SIZE = 1024 * 1024
+PATCH_JOBS = 6
+SMALI_INDEX_JOBS = 4
+APK_INDEX_JOBS = 4
+PATCH_CACHE_SIZE = 4 * 1024 ** 3
+# Keep a long-lived APKEditor JVM in each patch process, so that the JIT stays warm between jobs
+APKEDITOR_SERVER = True
+APKEDITOR_JVM_OPTIONS = ('-Xms512m', '-Xmx4g', '-XX:+UseParallelGC')
 MODIFY_PACKAGE = (
     'com.android.systemui',
     'com.android.launcher',
@@ -9,8 +9,8 @@ import ccglobal
 import config
 from build.apkfile import ApkFile
 from build.smali import MethodSpecifier
-from build.xml import XmlFile
-from util import template
+from build import xml
+from util import patchcache, task, template
 
 
 def rm_files():
@@ -45,11 +45,7 @@ def replace_installer():
 
 def disable_cn_gms():
     ccglobal.log('禁用国行 GMS 限制')
-    xml = XmlFile('my_product/etc/permissions/oplus_google_cn_gms_features.xml')
-    root = xml.get_root()
-    element = root.find('feature[@name="cn.google.services"]')
-    root.remove(element)
-    xml.commit()
+    xml.remove_elements('my_product/etc/permissions/oplus_google_cn_gms_features.xml', 'feature[@name="cn.google.services"]')
 
     with open('system/system/etc/init/hw/init.rc', 'r+', encoding='utf-8', newline='') as f:
         content = re.sub(r'(?<=setprop remote_provisioning\.hostname remoteprovisioning\.)googleapis\.com(?=\n)', 'grapheneos.org', f.read())
@@ -60,31 +56,21 @@ def disable_cn_gms():
 
 def disable_activity_start_dialog():
     ccglobal.log('禁用关联启动对话框')
-    xml = XmlFile('my_stock/etc/extension/com.oplus.oplus-feature.xml')
-    root = xml.get_root()
-
-    element = root.find('oplus-feature[@name="oplus.software.activity_start_manager"]')
-    root.remove(element)
-    element = root.find('oplus-feature[@name="oplus.software.instantapp_start_manager"]')
-    root.remove(element)
-
-    xml.commit()
+    xml.remove_elements('my_stock/etc/extension/com.oplus.oplus-feature.xml',
+                        'oplus-feature[@name="oplus.software.activity_start_manager"]',
+                        'oplus-feature[@name="oplus.software.instantapp_start_manager"]')
 
 
 def turn_off_flashlight_with_power_key():
     ccglobal.log('启用电源键关闭手电筒')
-    xml = XmlFile('system_ext/etc/permissions/com.oplus.features_config.xml')
-    root = xml.get_root()
-    element = root.find('oplus-feature[@name="oplus.software.powerkey_disbale_turnoff_torch"]')
-    root.remove(element)
-    xml.commit()
+    xml.remove_elements('system_ext/etc/permissions/com.oplus.features_config.xml', 'oplus-feature[@name="oplus.software.powerkey_disbale_turnoff_torch"]')
 
 
 def disable_signature_verification():
     apk = ApkFile('system/system/framework/framework.jar')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('禁用 V3 签名完整性验证')
     smali = apk.open_smali('android/util/apk/ApkSigningBlockUtils.smali')
@@ -125,21 +111,21 @@ def patch_oplus_services():
     apk = ApkFile('system/system/framework/oplus-services.jar')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('禁用 ADB 安装确认')
-    smali = apk.open_smali('com/android/server/pm/OplusPackageInstallInterceptManager.smali')
+    dex_class = apk.open_dex_class('com/android/server/pm/OplusPackageInstallInterceptManager')
     specifier = MethodSpecifier()
     specifier.name = 'allowInterceptAdbInstallInInstallStage'
     specifier.parameters = 'ILandroid/content/pm/PackageInstaller$SessionParams;Ljava/io/File;Ljava/lang/String;Landroid/content/pm/IPackageInstallObserver2;'
-    smali.method_return_boolean(specifier, False)
+    dex_class.method_return_boolean(specifier, False)
 
     ccglobal.log('去除已激活 VPN 通知')
-    smali = apk.open_smali('com/android/server/connectivity/VpnExtImpl.smali')
+    dex_class = apk.open_dex_class('com/android/server/connectivity/VpnExtImpl')
     specifier = MethodSpecifier()
     specifier.name = 'showNotification'
     specifier.parameters = 'Ljava/lang/String;IILjava/lang/String;Landroid/app/PendingIntent;Lcom/android/internal/net/VpnConfig;'
-    smali.method_nop(specifier)
+    dex_class.method_nop(specifier)
 
     apk.build(remove_oat=False)
     os.remove(f'{apk.file}.fsv_meta')
@@ -152,7 +138,7 @@ def patch_system_ui():
     apk = ApkFile('system_ext/priv-app/SystemUI/SystemUI.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('禁用控制中心时钟红1')
     smali = apk.open_smali('com/oplus/systemui/common/clock/OplusClockExImpl.smali')
@@ -255,7 +241,7 @@ def patch_launcher():
     apk = ApkFile('system_ext/priv-app/OplusLauncher/OplusLauncher.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('允许最近任务显示内存信息')
     smali = apk.open_smali('com/oplus/quickstep/memory/MemoryInfoManager.smali')
@@ -396,14 +382,14 @@ def disable_lock_screen_red_one():
     apk = ApkFile('system_ext/app/KeyguardClockBase/KeyguardClockBase.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('禁用锁屏时钟红1')
-    smali = apk.open_smali('com/oplus/keyguard/clock/base/widget/CustomizedTextView.smali')
+    dex_class = apk.open_dex_class('com/oplus/keyguard/clock/base/widget/CustomizedTextView')
     specifier = MethodSpecifier()
     specifier.name = 'setHourText'
     specifier.parameters = 'Z'
-    smali.method_nop(specifier)
+    dex_class.method_nop(specifier)
 
     apk.build()
 
@@ -431,14 +417,14 @@ def show_hidden_engineer_option():
     apk = ApkFile('system_ext/app/OplusCommercialEngineerMode/OplusCommercialEngineerMode.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('显示工程模式中的隐藏选项')
-    smali = apk.open_smali('com/oplus/engineermode/impl/SecrecyServiceHelper.smali')
+    dex_class = apk.open_dex_class('com/oplus/engineermode/impl/SecrecyServiceHelper')
     specifier = MethodSpecifier()
     specifier.name = 'getSecrecyState'
     specifier.parameters = 'I'
-    smali.method_return_boolean(specifier, False)
+    dex_class.method_return_boolean(specifier, False)
 
     apk.build()
 
@@ -690,7 +676,9 @@ def remove_traffic_monitor_ads():
     apk.decode()
 
     ccglobal.log('去除流量管理中的流量卡广告')
-    smali = apk.find_smali('"datausage_TrafficCardController"', '"updateHighDataSimCardConfiguration"').pop()
+    controller_results, utils_results = apk.find_smali_many(('"datausage_TrafficCardController"', '"updateHighDataSimCardConfiguration"'),
+                                                            ('"datausage_SysFeatureUtils"',))
+    smali = controller_results.pop()
     specifier = MethodSpecifier()
     specifier.access = MethodSpecifier.Access.PUBLIC
     specifier.is_final = True
@@ -714,7 +702,7 @@ def remove_traffic_monitor_ads():
     new_body = re.sub(pattern, repl, old_body)
     smali.method_replace(old_body, new_body)
 
-    smali = apk.find_smali('"datausage_SysFeatureUtils"').pop()
+    smali = utils_results.pop()
     specifier = MethodSpecifier()
     specifier.access = MethodSpecifier.Access.PUBLIC
     specifier.is_final = True
@@ -732,7 +720,7 @@ def show_icon_for_silent_notification():
     apk = ApkFile('system_ext/app/NotificationCenter/NotificationCenter.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('允许显示静默通知的图标')
     smali = apk.open_smali('com/oplus/notificationmanager/fragments/main/MoreSettingFragment.smali')
@@ -832,7 +820,7 @@ def remove_calendar_ads():
     apk = ApkFile('my_stock/app/Calendar/Calendar.apk')
     if apk.not_need_modify():
         return
-    apk.decode()
+    apk.decode(dex_only=True)
 
     ccglobal.log('去除日历广告')
     smali = apk.open_smali('com/android/calendar/module/subscription/almanac/adapter/AlmanacPagesAdapter.smali')
@@ -1100,31 +1088,37 @@ def ignore_modified_app_update():
     apk.build()
 
 
-def run_on_rom():
+def run_on_rom(jobs: int):
     rm_files()
     replace_installer()
     disable_cn_gms()
     disable_activity_start_dialog()
     turn_off_flashlight_with_power_key()
-    disable_signature_verification()
-    patch_oplus_services()
-    patch_system_ui()
-    patch_launcher()
-    patch_theme_store()
-    disable_lock_screen_red_one()
-    disable_launcher_clock_red_one()
-    show_hidden_engineer_option()
-    show_netmask_and_gateway()
-    patch_settings()
-    patch_phone_manager()
-    patch_tele_service()
-    remove_traffic_monitor_ads()
-    show_icon_for_silent_notification()
-    remove_system_notification_ads()
-    remove_mms_ads()
-    remove_calendar_ads()
-    patch_weather()
-    ignore_modified_app_update()
+
+    # Most patches decode and rebuild their own apk, run them in processes with the paths they touch.
+    # The result of a patch is cached by the input file, and replayed when the input has not changed.
+    task.run_exclusive(((patchcache.CachedPatch(func, file, paths), paths) for func, file, paths in (
+        (disable_signature_verification, 'system/system/framework/framework.jar', ('system/system/framework',)),
+        (patch_oplus_services, 'system/system/framework/oplus-services.jar', ('system/system/framework',)),
+        (patch_system_ui, 'system_ext/priv-app/SystemUI/SystemUI.apk', ('system_ext/priv-app/SystemUI',)),
+        (patch_launcher, 'system_ext/priv-app/OplusLauncher/OplusLauncher.apk', ('system_ext/priv-app/OplusLauncher',)),
+        (patch_theme_store, 'my_stock/app/KeKeThemeSpace/KeKeThemeSpace.apk', ('my_stock/app/KeKeThemeSpace',)),
+        (disable_lock_screen_red_one, 'system_ext/app/KeyguardClockBase/KeyguardClockBase.apk', ('system_ext/app/KeyguardClockBase',)),
+        (disable_launcher_clock_red_one, 'my_stock/app/Clock/Clock.apk', ('my_stock/app/Clock',)),
+        (show_hidden_engineer_option, 'system_ext/app/OplusCommercialEngineerMode/OplusCommercialEngineerMode.apk', ('system_ext/app/OplusCommercialEngineerMode',)),
+        (show_netmask_and_gateway, 'system_ext/priv-app/WirelessSettings/WirelessSettings.apk', ('system_ext/priv-app/WirelessSettings',)),
+        (patch_settings, 'system_ext/priv-app/Settings/Settings.apk', ('system_ext/priv-app/Settings',)),
+        (patch_phone_manager, 'my_stock/priv-app/PhoneManager/PhoneManager.apk', ('my_stock/priv-app/PhoneManager',)),
+        (patch_tele_service, 'system_ext/priv-app/TeleService/TeleService.apk', ('system_ext/priv-app/TeleService',)),
+        (remove_traffic_monitor_ads, 'system_ext/priv-app/TrafficMonitor/TrafficMonitor.apk', ('system_ext/priv-app/TrafficMonitor',)),
+        (show_icon_for_silent_notification, 'system_ext/app/NotificationCenter/NotificationCenter.apk', ('system_ext/app/NotificationCenter',)),
+        (remove_system_notification_ads, 'my_stock/app/MCS/MCS.apk', ('my_stock/app/MCS',)),
+        (remove_mms_ads, 'my_stock/priv-app/Mms/Mms.apk', ('my_stock/priv-app/Mms',)),
+        (remove_calendar_ads, 'my_stock/app/Calendar/Calendar.apk', ('my_stock/app/Calendar',)),
+        (patch_weather, 'my_stock/app/OppoWeather2/OppoWeather2.apk', ('my_stock/app/OppoWeather2',)),
+        (ignore_modified_app_update, 'my_stock/priv-app/KeKeMarket/KeKeMarket.apk', ('my_stock/priv-app/KeKeMarket',))
+    )), min(jobs, config.PATCH_JOBS))
+    patchcache.evict()
 
 
 def run_on_module():
@@ -0,0 +1,176 @@
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from zipfile import ZipFile
+
+import ccglobal
+import config
+from util import task, template, trace, zipwriter
+
+_ZSTD = f'{ccglobal.LIB_DIR}/zstd.exe'
+_BLOCK_SIZE = config.FLASH_BLOCK_SIZE
+# Ranges are listed in units of the dd block size of the flashing script, so that it does no arithmetic on byte offsets
+_DD_BLOCK_SIZE = 4096
+
+
+class _RomZip:
+    def __init__(self, file: str):
+        # CC_<device>_<version>_<md5>_<sdk>.zip, see main.compress_zip
+        splits = Path(file).stem.split('_')
+        if len(splits) < 5 or splits[0] != 'CC':
+            raise ValueError(f'不是 CC 全量包: {file}')
+        self.file = file
+        self.device = '_'.join(splits[1:-3])
+        self.version = splits[-3]
+        self.sdk = splits[-1]
+        with ZipFile(file, 'r') as zip_file:
+            self.images = {_partition_name(x): x for x in zip_file.namelist() if _partition_name(x)}
+
+
+def make_delta(old_file: str, new_file: str, jobs: int):
+    old_rom, new_rom = _RomZip(old_file), _RomZip(new_file)
+    if old_rom.device != new_rom.device:
+        raise ValueError(f'ROM 代号不一致: {old_rom.device}, {new_rom.device}')
+    ccglobal.log(f'构建增量包: {old_rom.version} -> {new_rom.version}')
+
+    os.makedirs('images', exist_ok=True)
+    results = task.run_parallel(lambda x: _diff(old_rom, new_rom, x), sorted(new_rom.images), jobs)
+    partitions = [x for x in sorted(results) if results[x]]
+    if not partitions:
+        ccglobal.log('两个版本的镜像完全相同')
+        return
+
+    check_output = io.StringIO()
+    flash_output = io.StringIO()
+    for partition in partitions:
+        if partition == 'super':
+            targets = '"/dev/block/bootdevice/by-name/super"'
+        else:
+            targets = f'"/dev/block/bootdevice/by-name/{partition}_a" "/dev/block/bootdevice/by-name/{partition}_b"'
+        check_output.write(f'checkDelta "images/{partition}" {targets}\n')
+        flash_output.write(f'flashDelta "images/{partition}" {targets}\n')
+    if 'super' in partitions:
+        flash_output.write('\n')
+        for item in config.SUPER_PARTITIONS:
+            flash_output.write(f'remapSuper {item}_a\n')
+
+    template_dict = {
+        'var_device': new_rom.device,
+        'var_source_version': old_rom.version,
+        'var_version': new_rom.version,
+        'var_sdk': new_rom.sdk,
+        'var_check_delta': check_output.getvalue(),
+        'var_flash_delta': flash_output.getvalue()
+    }
+    flash_script_dir = Path('META-INF/com/google/android')
+    flash_script_dir.mkdir(parents=True, exist_ok=True)
+    template.substitute(f'{ccglobal.MISC_DIR}/update-binary-delta', f'{flash_script_dir}/update-binary', mapping=template_dict)
+    shutil.copy(f'{ccglobal.MISC_DIR}/zstd', flash_script_dir.joinpath('zstd'))
+
+    ccglobal.log('打包 Zip 文件')
+    md5 = hashlib.md5()
+    with open('tmp.zip', 'wb') as f, zipwriter.ZipWriter(f, jobs, md5) as zip_file:
+        zip_file.write_tree('META-INF')
+        for partition in partitions:
+            zip_file.write(f'images/{partition}.delta')
+            zip_file.write(f'images/{partition}.delta.zst', compress=False)
+    filename = f'CC_{new_rom.device}_{old_rom.version}-{new_rom.version}_{md5.hexdigest()[:10]}_{new_rom.sdk}.zip'
+    os.rename('tmp.zip', filename)
+    ccglobal.log(f'增量包文件: {Path(filename).resolve().as_posix()}')
+
+
+def _diff(old_rom: _RomZip, new_rom: _RomZip, partition: str):
+    # The changed ranges of the new image are written to <partition>.delta.zst, and listed in <partition>.delta as first block
+    # and block count after a header with the size and SHA-256 of both images. Only the range at the end of the image may
+    # hold a partial block. Missing source partitions count as empty.
+    source_hash = hashlib.sha256()
+    target_hash = hashlib.sha256()
+    source_size = target_size = 0
+    ranges: list[list[int]] = []
+
+    cmd = [_ZSTD, '-q', '-f', '-o', f'images/{partition}.delta.zst']
+    with (_open_image(old_rom, partition) as old, _open_image(new_rom, partition) as new,
+          subprocess.Popen(cmd, stdin=subprocess.PIPE) as process, trace.watch(process)):
+        try:
+            while new_block := new.read(_BLOCK_SIZE):
+                old_block = old.read(_BLOCK_SIZE) if old else b''
+                source_hash.update(old_block)
+                target_hash.update(new_block)
+                source_size += len(old_block)
+                if old_block[:len(new_block)] != new_block:
+                    process.stdin.write(new_block)
+                    if ranges and ranges[-1][0] + ranges[-1][1] == target_size:
+                        ranges[-1][1] += len(new_block)
+                    else:
+                        ranges.append([target_size, len(new_block)])
+                target_size += len(new_block)
+            while old and (old_block := old.read(_BLOCK_SIZE)):
+                source_hash.update(old_block)
+                source_size += len(old_block)
+        finally:
+            process.stdin.close()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    if not ranges and source_size == target_size:
+        os.remove(f'images/{partition}.delta.zst')
+        ccglobal.log(f'分区未改变: {partition}')
+        return False
+    with open(f'images/{partition}.delta', 'w', encoding='utf-8', newline='\n') as f:
+        f.write(f'{source_size} {source_hash.hexdigest()} {target_size} {target_hash.hexdigest()}\n')
+        f.writelines(f'{offset // _DD_BLOCK_SIZE} {-(-length // _DD_BLOCK_SIZE)}\n' for offset, length in ranges)
+    changed = sum(length for _, length in ranges)
+    ccglobal.log(f'增量分区: {partition}, 改变 {changed / 1024 / 1024:.1f} MB / {target_size / 1024 / 1024:.1f} MB')
+    return True
+
+
+@contextmanager
+def _open_image(rom: _RomZip, partition: str):
+    # Images are read as streams straight from the zip, super.img.zst is decompressed on the fly
+    if partition not in rom.images:
+        yield None
+        return
+
+    name = rom.images[partition]
+    with ZipFile(rom.file, 'r') as zip_file, zip_file.open(name) as entry:
+        if not name.endswith('.zst'):
+            yield entry
+            return
+
+        cmd = [_ZSTD, '-q', '-d', '-c']
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process, trace.watch(process):
+            def feed():
+                try:
+                    shutil.copyfileobj(entry, process.stdin, _BLOCK_SIZE)
+                except OSError:
+                    pass
+                finally:
+                    process.stdin.close()
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            try:
+                yield process.stdout
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                feeder.join()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def _partition_name(name: str):
+    if not name.startswith('images/') or name.count('/') != 1:
+        return None
+    if name.endswith('.img'):
+        return name[7:-4]
+    if name == 'images/super.img.zst':
+        return 'super'
+    return None
@@ -7,6 +7,7 @@ import re
 import shutil
 import subprocess
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import iglob
 from pathlib import Path, PurePath
 
@@ -14,24 +15,64 @@ import appupdate
 import ccglobal
 import config
 import customize
+import delta
 import opexupdate
 import vbmeta
-from util import imgfile, template
+from util import blockhash, checkpoint, erofs, fsconfig, imgfile, payload, sparseimg, superimg, task, template, trace, zipwriter
+
+ROM_STAGES = ('dump_payload', 'unpack_img', 'custom_kernel', 'disable_avb_and_dm_verity', 'move_deletable_apk', 'update_opex', 'update_app', 'customize',
+              'dump_passthrough_payload', 'install_lkm', 'patch_vbmeta', 'repack_img', 'repack_super', 'generate_script', 'compress_zip')
+# The stages edit their inputs in place, so a rerun has to start over from the stage that produces those inputs again
+ROM_RESTARTS = {
+    # The extracted images are overwritten once repack_img starts, until then they can be unpacked again
+    'unpack_img': ('dump_payload', 'repack_img'),
+    'custom_kernel': ('unpack_img', None),
+    'disable_avb_and_dm_verity': ('unpack_img', None),
+    'move_deletable_apk': ('unpack_img', None),
+    'update_opex': ('unpack_img', None),
+    'update_app': ('unpack_img', None),
+    'customize': ('unpack_img', None),
+    # init_boot and vbmeta images are patched in place
+    'install_lkm': ('dump_passthrough_payload', None),
+    'patch_vbmeta': ('dump_passthrough_payload', None),
+    # update-binary is moved into the zip tree
+    'compress_zip': ('generate_script', None),
+}
+
+
+def dump_payload(file: str, jobs: int):
+    ccglobal.log(f'解压 Payload: {file}')
+    partitions = [x for x in payload.partitions(file) if x in config.UNPACK_PARTITIONS]
+    extract_payload(file, partitions, jobs)
 
 
-def dump_payload(file: str):
-    ccglobal.log(f'解压 Payload: {file}')
+def dump_passthrough_payload(file: str, jobs: int) -> Future:
+    # Recovery is removed, my_company and my_preload are replaced with blank images, no need to extract them
+    partitions = [x for x in payload.partitions(file) if x not in config.UNPACK_PARTITIONS and x not in ('recovery', 'my_company', 'my_preload')]
+
+    # These images are only passed through, extract them in background while unpacking and patching
+    executor = ThreadPoolExecutor(1)
+    future = executor.submit(extract_payload, file, partitions, jobs)
+    executor.shutdown(wait=False)
+    return future
+
+
+def extract_payload(file: str, partitions: list[str], jobs: int):
     payload_extract = f'{ccglobal.LIB_DIR}/payload_extract.exe'
-    subprocess.run([payload_extract, '-x', '-i', file, '-o', 'images'], check=True)
 
+    def extract(partition: str):
+        ccglobal.log(f'解压分区: {partition}')
+        task.run([payload_extract, '-X', partition, '-i', file, '-o', 'images'])
+
+    task.run_parallel(extract, partitions, jobs)
 
-def unpack_img():
+
+def unpack_img(jobs: int):
     ccglobal.log('去除官方 Recovery')
     recovery = Path('images/recovery.img')
     recovery.unlink(True)
 
-    for partition in config.UNPACK_PARTITIONS:
-        imgfile.unpack(f'images/{partition}.img', partition)
+    task.run_parallel(lambda x: imgfile.unpack(f'images/{x}.img', x), config.UNPACK_PARTITIONS, jobs)
 
 
 def read_rom_information():
@@ -72,7 +113,7 @@ def install_lkm(no_lkm: bool):
 
     ksud = f'{ccglobal.LIB_DIR}/ksud.exe'
     magiskboot = f'{ccglobal.LIB_DIR}/magiskboot.exe'
-    subprocess.run([ksud, 'boot-patch', '--magiskboot', magiskboot, '-b', 'images/init_boot.img', '--kmi', ccglobal.kmi, '--out-name', 'images/init_boot.img'], check=True)
+    trace.run([ksud, 'boot-patch', '--magiskboot', magiskboot, '-b', 'images/init_boot.img', '--kmi', ccglobal.kmi, '--out-name', 'images/init_boot.img'], check=True)
 
 
 def patch_vbmeta():
@@ -108,10 +149,24 @@ def move_deletable_apk():
         shutil.move(dir_path, dir_path.parent.parent.joinpath('app'))
 
 
-def repack_img():
-    for partition in config.UNPACK_PARTITIONS:
-        imgfile.sync_app_perm_and_context(partition)
-        imgfile.repack(f'images/{partition}.img', partition)
+def repack_img(jobs: int):
+    sizes = task.run_parallel(imgfile.dir_size, config.UNPACK_PARTITIONS, jobs)
+
+    def repack(partition: str):
+        start = time.time()
+        img = f'images/{partition}.img'
+        if not imgfile.is_modified(partition):
+            ccglobal.log(f'分区未修改, 沿用原镜像: {img}')
+            return
+        fsconfig.sync(partition)
+        imgfile.repack(img, partition)
+        ratio = os.path.getsize(img) / max(sizes[partition], 1)
+        ccglobal.log(f'打包完成: {img}, 耗时 {time.time() - start:.1f} 秒, 压缩率 {ratio:.1%}')
+
+    # Start the largest partitions first, so that they do not become the tail of the schedule
+    partitions = sorted(config.UNPACK_PARTITIONS, key=lambda x: sizes[x], reverse=True)
+    # Every mkfs.erofs process holds a large amount of memory, so limit the number of them
+    task.run_parallel(repack, partitions, min(jobs, config.REPACK_JOBS))
 
     ccglobal.log('清空 my_company 和 my_preload 分区')
     shutil.copy(f'{ccglobal.MISC_DIR}/BlankErofs.img', 'images/my_company.img')
@@ -120,45 +175,64 @@ def repack_img():
 
 def repack_super():
     ccglobal.log('打包 super.img')
-    cmd = [f'{ccglobal.LIB_DIR}/lpmake.exe',
-           '--metadata-size', '65536',
-           '--super-name', 'super',
-           '--metadata-slots', '3',
-           '--virtual-ab', '--device', f'super:{config.SUPER_SIZE}',
-           '--group', f'qti_dynamic_partitions_a:{config.SUPER_SIZE}',
-           '--group', f'qti_dynamic_partitions_b:{config.SUPER_SIZE}']
-
+    groups = {'qti_dynamic_partitions_a': config.SUPER_SIZE, 'qti_dynamic_partitions_b': config.SUPER_SIZE}
+    partitions = []
     for partition in config.SUPER_PARTITIONS:
         img = f'images/{partition}.img'
-        size = os.path.getsize(img)
+        size = sparseimg.raw_size(img)
         ccglobal.log(f'动态分区: {partition}, 大小: {size} 字节')
-        cmd += ['--partition', f'{partition}_a:readonly:{size}:qti_dynamic_partitions_a', '--image', f'{partition}_a={img}']
-        cmd += ['--partition', f'{partition}_b:none:0:qti_dynamic_partitions_b']
+        partitions.append((f'{partition}_a', 'readonly', 'qti_dynamic_partitions_a', img))
+        partitions.append((f'{partition}_b', 'none', 'qti_dynamic_partitions_b', None))
 
-    cmd.append('--force-full-image')
-    cmd += ['--output', 'images/super.img']
-    subprocess.run(cmd, check=True)
+    zstd = f'{ccglobal.LIB_DIR}/zstd.exe'
+    if config.SUPER_LPMAKE:
+        cmd = [f'{ccglobal.LIB_DIR}/lpmake.exe',
+               '--metadata-size', '65536',
+               '--super-name', 'super',
+               '--metadata-slots', '3',
+               '--virtual-ab', '--device', f'super:{config.SUPER_SIZE}']
+        for group, size in groups.items():
+            cmd += ['--group', f'{group}:{size}']
+        for name, attributes, group, img in partitions:
+            cmd += ['--partition', f'{name}:{attributes}:{sparseimg.raw_size(img) if img else 0}:{group}']
+            if img:
+                cmd += ['--image', f'{name}={img}']
+        cmd.append('--force-full-image')
+        cmd += ['--output', 'images/super.img']
+        trace.run(cmd, check=True)
+
+        ccglobal.log('使用 zstd 压缩 super.img')
+        trace.run([zstd, '--rm', 'images/super.img', '-o', 'images/super.img.zst'], check=True)
+    else:
+        ccglobal.log('使用 zstd 流式压缩 super.img')
+        cmd = [zstd, '--stream-size', str(config.SUPER_SIZE), '-o', 'images/super.img.zst']
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE) as process, trace.watch(process):
+            try:
+                superimg.write(process.stdin, config.SUPER_SIZE, groups, partitions)
+            finally:
+                process.stdin.close()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
 
-    for partition in config.SUPER_PARTITIONS:
-        img = f'images/{partition}.img'
-        if os.path.exists(img):
-            os.remove(img)
 
-    ccglobal.log('使用 zstd 压缩 super.img')
-    zstd = f'{ccglobal.LIB_DIR}/zstd.exe'
-    subprocess.run([zstd, '--rm', 'images/super.img', '-o', 'images/super.img.zst'], check=True)
+def shipped_images():
+    # The dynamic partition images stay in images/ so that repack_super can run again, but only super.img.zst is shipped
+    for img in sorted(os.listdir('images')):
+        if img.endswith('.img') and os.path.splitext(img)[0] in config.SUPER_PARTITIONS and os.path.exists('images/super.img.zst'):
+            continue
+        yield img
 
 
 def generate_script():
     ccglobal.log('生成刷机脚本')
     output = io.StringIO()
 
-    for img in os.listdir('images'):
+    for img in shipped_images():
         if not img.endswith('.img'):
             continue
         partition = os.path.splitext(img)[0]
-        output.write(f'flash "images/{img}" "/dev/block/bootdevice/by-name/{partition}_a"\n')
-        output.write(f'flash "images/{img}" "/dev/block/bootdevice/by-name/{partition}_b"\n')
+        blockhash.write_manifest(f'images/{img}')
+        output.write(f'flashDiff "images/{img}" "/dev/block/bootdevice/by-name/{partition}_a" "/dev/block/bootdevice/by-name/{partition}_b"\n')
     if os.path.exists('images/super.img.zst'):
         output.write('flashZstd "images/super.img.zst" "/dev/block/bootdevice/by-name/super"\n\n')
         for item in config.SUPER_PARTITIONS:
@@ -194,23 +268,19 @@ def generate_script():
     template.substitute(f'{ccglobal.MISC_DIR}/update-binary', mapping=template_dict)
 
 
-def compress_zip():
+def compress_zip(jobs: int):
     ccglobal.log('打包 Zip 文件')
-    _7z = f'{ccglobal.LIB_DIR}/7za.exe'
-    cmd = [_7z, 'a', 'tmp.zip', 'META-INF']
-    for img in os.listdir('images'):
-        cmd.append(f'images/{img}')
-
     flash_script_dir = Path('META-INF/com/google/android')
     flash_script_dir.mkdir(parents=True, exist_ok=True)
     shutil.move('update-binary', flash_script_dir.joinpath('update-binary'))
     shutil.copy(f'{ccglobal.MISC_DIR}/zstd', flash_script_dir.joinpath('zstd'))
 
-    subprocess.run(cmd, check=True)
-
     md5 = hashlib.md5()
-    with open('tmp.zip', 'rb') as f:
-        md5.update(f.read())
+    with open('tmp.zip', 'wb') as f, zipwriter.ZipWriter(f, jobs, md5) as zip_file:
+        zip_file.write_tree('META-INF')
+        for img in shipped_images():
+            # Already compressed entries are stored as is
+            zip_file.write(f'images/{img}', compress=not img.endswith('.zst'))
     filename = f'CC_{ccglobal.device}_{ccglobal.version}{ccglobal.patch_number_suffix()}_{md5.hexdigest()[:10]}_{ccglobal.sdk}.zip'
     os.rename('tmp.zip', filename)
     ccglobal.log(f'全量包文件: {Path(filename).resolve().as_posix()}')
@@ -220,9 +290,11 @@ def print_opex(args: argparse.Namespace):
     ccglobal.log('打印 Opex 更新信息')
     if args.file:
         payload_extract = f'{ccglobal.LIB_DIR}/payload_extract.exe'
-        extract_erofs = f'{ccglobal.LIB_DIR}/extract.erofs.exe'
-        subprocess.run([payload_extract, '-X', 'my_manifest', '-i', args.file, '-o', 'images'], check=True)
-        subprocess.run([extract_erofs, '-X', 'build.prop', '-i', 'images/my_manifest.img'], check=True)
+        trace.run([payload_extract, '-X', 'my_manifest', '-i', args.file, '-o', 'images'], check=True)
+        # Only build.prop is needed, read it from the image instead of extracting the whole partition
+        os.makedirs('my_manifest', exist_ok=True)
+        with erofs.ErofsImage('images/my_manifest.img') as image, open('my_manifest/build.prop', 'wb') as f:
+            image.extract('build.prop', f)
 
     opex_list = opexupdate.fetch_opex()
     if not opex_list:
@@ -239,6 +311,58 @@ def print_opex(args: argparse.Namespace):
     print(f'+{'':-<17}+{'':-<11}+{'':-<135}+')
 
 
+def benchmark_erofs(args: argparse.Namespace):
+    ccglobal.log('测试 EROFS 压缩配置')
+    # The config files of the build are left as they are, the benchmark syncs and uses its own copies
+    config_dir = 'benchmark/config'
+    os.makedirs(config_dir, exist_ok=True)
+    profiles = args.profiles or tuple(config.EROFS_BENCHMARK_PROFILES)
+    results = []
+    # Runs one at a time, so that the timings do not disturb each other
+    for partition in args.partitions:
+        if not os.path.isfile(f'config/{partition}_fs_type'):
+            ccglobal.log(f'跳过未解包的分区: {partition}')
+            continue
+        with open(f'config/{partition}_fs_type', 'r', encoding='utf-8') as f:
+            if imgfile.FileSystem[f.read()] != imgfile.FileSystem.EROFS:
+                ccglobal.log(f'跳过非 EROFS 分区: {partition}')
+                continue
+        for suffix in ('fs_type', 'fs_config', 'file_contexts', 'fs_config.orig', 'file_contexts.orig'):
+            if os.path.isfile(f'config/{partition}_{suffix}'):
+                shutil.copy(f'config/{partition}_{suffix}', f'{config_dir}/{partition}_{suffix}')
+            else:
+                Path(f'{config_dir}/{partition}_{suffix}').unlink(True)
+        fsconfig.sync(partition, config_dir=config_dir)
+        tree_size = imgfile.dir_size(partition)
+        for profile in profiles:
+            img = f'benchmark/{partition}-{profile}.img'
+            start = time.time()
+            imgfile.repack(img, partition, compression=config.EROFS_BENCHMARK_PROFILES[profile], config_dir=config_dir)
+            build_time = time.time() - start
+            size = os.path.getsize(img)
+
+            # Decompression throughput of the host extract.erofs, the write of the extracted files is included
+            extract_dir = f'benchmark/{partition}-{profile}'
+            start = time.time()
+            imgfile.extract_erofs(img, extract_dir)
+            extract_time = time.time() - start
+            shutil.rmtree(extract_dir)
+            os.remove(img)
+            results.append({'partition': partition, 'profile': profile, 'build_time': build_time, 'size': size,
+                            'ratio': size / max(tree_size, 1), 'throughput': tree_size / max(extract_time, 1e-6)})
+
+    with open('benchmark/result.json', 'w', encoding='utf-8', newline='') as f:
+        json.dump(results, f, indent=4)
+
+    print(f'+{'':-<20}+{'':-<20}+{'':-<11}+{'':-<13}+{'':-<9}+{'':-<14}+')
+    print(f'| {'Partition':18} | {'Profile':18} | {'Build':9} | {'Size':11} | {'Ratio':7} | {'Extract':12} |')
+    print(f'+{'':-<20}+{'':-<20}+{'':-<11}+{'':-<13}+{'':-<9}+{'':-<14}+')
+    for item in results:
+        print(f'| {item['partition']:18} | {item['profile']:18} | {item['build_time']:>7.1f} s | {item['size'] / 1024 / 1024:>8.1f} MB '
+              f'| {item['ratio']:>7.1%} | {item['throughput'] / 1024 / 1024:>7.1f} MB/s |')
+    print(f'+{'':-<20}+{'':-<20}+{'':-<11}+{'':-<13}+{'':-<9}+{'':-<14}+')
+
+
 def make_module(args: argparse.Namespace):
     ccglobal.log('构建系统更新模块')
     opexupdate.run_on_module(args.opex_files)
@@ -260,26 +384,53 @@ def make_module(args: argparse.Namespace):
     template.substitute(template_dir.joinpath('module.prop'), var_version_code=version_code, var_version=version_name)
 
     _7z = f'{ccglobal.LIB_DIR}/7za.exe'
-    subprocess.run([_7z, 'a', f'CC-Patch_{version_name}.zip', 'module.prop', 'system', 'customize.sh', 'post-fs-data.sh'], check=True)
+    trace.run([_7z, 'a', f'CC-Patch_{version_name}.zip', 'module.prop', 'system', 'customize.sh', 'post-fs-data.sh'], check=True)
 
 
 def make_rom(args: argparse.Namespace):
     ccglobal.log('构建全量包')
-    dump_payload(args.file)
-    unpack_img()
+    fingerprint = checkpoint.fingerprint(args.file, args.opex_files, args.kernel, args.no_lkm)
+    stages = checkpoint.Checkpoint(ROM_STAGES, fingerprint, resume=args.resume, from_stage=args.from_stage, restarts=ROM_RESTARTS)
+
+    if stages.begin('dump_payload'):
+        dump_payload(args.file, args.jobs)
+    # The background extraction takes its share of the jobs, the stages running next to it get the rest
+    extracting = None
+    jobs = args.jobs
+    if stages.will_run('dump_passthrough_payload'):
+        background_jobs = min(config.PASSTHROUGH_EXTRACT_JOBS, max(args.jobs - 1, 1))
+        jobs = max(args.jobs - background_jobs, 1)
+        extracting = dump_passthrough_payload(args.file, background_jobs)
+    if stages.begin('unpack_img'):
+        unpack_img(jobs)
     read_rom_information()
-    custom_kernel(args.kernel)
-    install_lkm(args.no_lkm)
-    patch_vbmeta()
-    disable_avb_and_dm_verity()
-    move_deletable_apk()
-    opexupdate.run_on_rom(args.opex_files)
-    appupdate.run_on_rom()
-    customize.run_on_rom()
-    repack_img()
-    repack_super()
-    generate_script()
-    compress_zip()
+    if stages.begin('custom_kernel'):
+        custom_kernel(args.kernel)
+    if stages.begin('disable_avb_and_dm_verity'):
+        disable_avb_and_dm_verity()
+    if stages.begin('move_deletable_apk'):
+        move_deletable_apk()
+    if stages.begin('update_opex'):
+        opexupdate.run_on_rom(args.opex_files)
+    if stages.begin('update_app'):
+        appupdate.run_on_rom()
+    if stages.begin('customize'):
+        customize.run_on_rom(jobs)
+    if stages.begin('dump_passthrough_payload'):
+        extracting.result()
+    if stages.begin('install_lkm'):
+        install_lkm(args.no_lkm)
+    if stages.begin('patch_vbmeta'):
+        patch_vbmeta()
+    if stages.begin('repack_img'):
+        repack_img(args.jobs)
+    if stages.begin('repack_super'):
+        repack_super()
+    if stages.begin('generate_script'):
+        generate_script()
+    if stages.begin('compress_zip'):
+        compress_zip(args.jobs)
+    stages.finish()
 
 
 def main():
@@ -292,6 +443,9 @@ def main():
     rom_parser.add_argument('-x', '--opex-files', nargs='+', help='需要处理的 Opex 包')
     rom_parser.add_argument('-k', '--kernel', help='自定义内核镜像')
     rom_parser.add_argument('--no-lkm', action='store_true', help='不安装 KernelSU LKM')
+    rom_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='并行任务数')
+    rom_parser.add_argument('--resume', action='store_true', help='跳过已完成的构建阶段')
+    rom_parser.add_argument('--from-stage', choices=ROM_STAGES, help='从指定阶段开始重新构建')
 
     module_parser = argparse.ArgumentParser(add_help=False)
     module_parser.add_argument('-x', '--opex-files', nargs='+', help='需要处理的 Opex 包')
@@ -299,26 +453,49 @@ def main():
     opex_parser = argparse.ArgumentParser(add_help=False)
     opex_parser.add_argument('-f', '--file', help='需要处理的 ROM 包')
 
+    benchmark_parser = argparse.ArgumentParser(add_help=False)
+    benchmark_parser.add_argument('partitions', nargs='+', help='需要测试的分区, 使用输出文件夹中已解包的内容')
+    benchmark_parser.add_argument('-p', '--profiles', nargs='+', choices=config.EROFS_BENCHMARK_PROFILES, help='需要测试的压缩配置')
+
+    delta_parser = argparse.ArgumentParser(add_help=False)
+    delta_parser.add_argument('source', help='旧版本的 CC 全量包')
+    delta_parser.add_argument('target', help='新版本的 CC 全量包')
+    delta_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='并行任务数')
+
     out_parser = argparse.ArgumentParser(add_help=False)
     out_parser.add_argument('-o', '--out-dir', help='输出文件夹', default='out')
+    out_parser.add_argument('--trace', action='store_true', help='记录各阶段和外部工具的性能数据')
     out_parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='显示帮助信息')
 
     subparsers.add_parser('rom', help='构建全量包', parents=[rom_parser, out_parser], add_help=False)
     subparsers.add_parser('module', help='构建系统更新模块', parents=[module_parser, out_parser], add_help=False)
     subparsers.add_parser('opex', help='打印 Opex 更新信息', parents=[opex_parser, out_parser], add_help=False)
+    subparsers.add_parser('delta', help='构建增量包', parents=[delta_parser, out_parser], add_help=False)
+    subparsers.add_parser('benchmark', help='测试 EROFS 压缩配置', parents=[benchmark_parser, out_parser], add_help=False)
     args = parser.parse_args()
 
-    os.mkdir(args.out_dir)
+    # Resuming a build and the benchmark work on the existing output folder
+    os.makedirs(args.out_dir, exist_ok=args.command == 'benchmark' or getattr(args, 'resume', False) or getattr(args, 'from_stage', None) is not None)
     os.chdir(args.out_dir)
+    if args.trace:
+        trace.enable()
 
     start = time.time()
-    match args.command:
-        case 'rom':
-            make_rom(args)
-        case 'module':
-            make_module(args)
-        case 'opex':
-            print_opex(args)
+    try:
+        with trace.Span(args.command, 'command'):
+            match args.command:
+                case 'rom':
+                    make_rom(args)
+                case 'module':
+                    make_module(args)
+                case 'opex':
+                    print_opex(args)
+                case 'benchmark':
+                    benchmark_erofs(args)
+                case 'delta':
+                    delta.make_delta(args.source, args.target, args.jobs)
+    finally:
+        trace.export()
     result = time.time() - start
     ccglobal.log(f'已完成, 耗时 {int(result / 60)} 分 {int(result % 60)} 秒')
 
@@ -0,0 +1,35 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+
+public class ApkEditorServer {
+    private static final String READY = "\0CC-READY";
+    private static final String JOB_END = "\0CC-END ";
+
+    public static void main(String[] args) throws Exception {
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, StandardCharsets.UTF_8);
+        System.setOut(out);
+        System.setErr(out);
+
+        Method execute = Class.forName("com.reandroid.apkeditor.Main").getMethod("execute", String[].class);
+        out.println(READY);
+
+        BufferedReader reader = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = reader.readLine()) != null) {
+            int result;
+            try {
+                result = (int) execute.invoke(null, (Object) line.split("\0"));
+            } catch (InvocationTargetException e) {
+                e.getCause().printStackTrace();
+                result = 1;
+            }
+            out.println(JOB_END + result);
+        }
+    }
+}
@@ -16,6 +16,7 @@ from util import adb
 from util import crypto
 from util import imgfile
 from util import myoverlay
+from util import trace
 
 
 class RegionCN(Enum):
@@ -161,7 +162,7 @@ def unpack_img(opex_files: list[str]):
     ccglobal.patch_number = 0
     _7z = f'{ccglobal.LIB_DIR}/7za.exe'
     for file in opex_files:
-        subprocess.run([_7z, 'e', file, 'opex.cfg', '-oopex'], check=True, stdout=subprocess.DEVNULL)
+        trace.run([_7z, 'e', file, 'opex.cfg', '-oopex'], check=True, stdout=subprocess.DEVNULL)
         with open('opex/opex.cfg', 'r', encoding='utf-8') as f:
             json_dict = json.load(f)
             business_code = json_dict['businessCode']
@@ -171,7 +172,7 @@ def unpack_img(opex_files: list[str]):
                 ccglobal.device = ota_version_limits.pop().split('_')[0]
         os.remove('opex/opex.cfg')
 
-        subprocess.run([_7z, 'e', file, 'opex.img', '-oopex'], check=True, stdout=subprocess.DEVNULL)
+        trace.run([_7z, 'e', file, 'opex.img', '-oopex'], check=True, stdout=subprocess.DEVNULL)
         imgfile.unpack('opex/opex.img', business_code, 'opex')
         os.remove('opex/opex.img')
 
@@ -3,6 +3,7 @@ import subprocess
 
 import ccglobal
 import config
+from util import trace
 
 _DATA_TMP_DIR = '/data/local/tmp'
 _MODULE_DIR = '/data/adb/modules/colorcleaner'
@@ -10,7 +11,7 @@ _OVERLAYFS_MODULE_DIR = '/data/adb/metamodule/mnt/colorcleaner'
 
 
 def is_connected():
-    lines = subprocess.run(['adb', 'devices'], stdout=subprocess.PIPE).stdout.decode().strip().splitlines()
+    lines = trace.run(['adb', 'devices'], stdout=subprocess.PIPE).stdout.decode().strip().splitlines()
     num = len(lines)
     if num == 2:
         return True
@@ -23,19 +24,19 @@ def is_connected():
 
 
 def execute(command: str):
-    return subprocess.run(['adb', 'shell', 'su', '-c', f'"{command}"']).returncode
+    return trace.run(['adb', 'shell', 'su', '-c', f'"{command}"']).returncode
 
 
 def getoutput(command: str):
-    popen = subprocess.Popen(['adb', 'shell', 'su', '-c', f'"{command}"'], stdout=subprocess.PIPE, universal_newlines=True)
-    return popen.stdout
+    process = trace.run(['adb', 'shell', 'su', '-c', f'"{command}"'], stdout=subprocess.PIPE, universal_newlines=True)
+    return process.stdout.splitlines(keepends=True)
 
 
 def push(src: str, dst: str):
     if dst.startswith('/sdcard'):
-        subprocess.run(['adb', 'push', src, dst], stdout=subprocess.DEVNULL)
+        trace.run(['adb', 'push', src, dst], stdout=subprocess.DEVNULL)
     else:
-        subprocess.run(['adb', 'push', src, _DATA_TMP_DIR], stdout=subprocess.DEVNULL)
+        trace.run(['adb', 'push', src, _DATA_TMP_DIR], stdout=subprocess.DEVNULL)
         tmp_file = f'{_DATA_TMP_DIR}/{os.path.basename(src)}'
         # Use cp and rm commands to avoid moving file permissions simultaneously
         execute(f'cp -rf {tmp_file} {dst}')
@@ -44,7 +45,7 @@ def push(src: str, dst: str):
 
 def pull(src: str, dst: str | os.PathLike[str]):
     ccglobal.log(f'拉取设备文件: {src}')
-    subprocess.run(['adb', 'pull', src, os.fspath(dst)], stdout=subprocess.DEVNULL)
+    trace.run(['adb', 'pull', src, os.fspath(dst)], stdout=subprocess.DEVNULL)
 
 
 def install_test_module():
@@ -1,15 +1,96 @@
+import atexit
+import os
 import subprocess
+import threading
 
 import ccglobal
+import config
+from util import task, trace
+
+_APK_EDITOR = f'{ccglobal.LIB_DIR}/APKEditor.jar'
+_SERVER_SOURCE = f'{ccglobal.MISC_DIR}/ApkEditorServer.java'
+_SERVER_READY = '\0CC-READY'
+_SERVER_JOB_END = '\0CC-END '
+
+
+class _Server:
+    def __init__(self):
+        self._process: subprocess.Popen | None = None
+        self._pid = None
+        self._available = True
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def execute(self, args: tuple[str, ...]) -> int | None:
+        with self._lock:
+            # Restart the server and retry the job once if the server crashes
+            for _ in range(2):
+                if not self._start():
+                    return None
+                try:
+                    return self._request(args)
+                except (BrokenPipeError, EOFError):
+                    ccglobal.log('APKEditor 服务异常退出, 正在重启')
+                    self.stop()
+            return None
+
+    def stop(self):
+        if not self._process or self._pid != os.getpid():
+            return
+        try:
+            self._process.stdin.close()
+            self._process.wait(10)
+        except (OSError, subprocess.TimeoutExpired):
+            self._process.kill()
+        self._process = None
+
+    def _start(self):
+        # The process is inherited by a forked worker, it belongs to the parent
+        if self._process and self._pid == os.getpid() and self._process.poll() is None:
+            return True
+        if not self._available:
+            return False
+
+        cmd = ['java', *config.APKEDITOR_JVM_OPTIONS, '-cp', _APK_EDITOR, _SERVER_SOURCE]
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', errors='replace')
+        self._pid = os.getpid()
+        for line in self._process.stdout:
+            if line.startswith(_SERVER_READY):
+                return True
+            ccglobal.write_log(line)
+
+        ccglobal.log('APKEditor 服务启动失败, 使用命令行模式')
+        self._available = False
+        self._process = None
+        return False
+
+    def _request(self, args: tuple[str, ...]):
+        with trace.watch(self._process, ['java', *args]):
+            self._process.stdin.write('\0'.join(args) + '\n')
+            self._process.stdin.flush()
+            for line in self._process.stdout:
+                if line.startswith(_SERVER_JOB_END):
+                    return int(line[len(_SERVER_JOB_END):])
+                ccglobal.write_log(line)
+        raise EOFError
+
+
+_server = _Server()
 
 
 def decode(file: str, output: str, resource_type: str = 'xml'):
-    subprocess.run(['java', '-jar', f'{ccglobal.LIB_DIR}/APKEditor.jar', 'd', '-t', resource_type, '-i', file, '-o', output], stderr=subprocess.STDOUT)
+    _execute('d', '-t', resource_type, '-i', file, '-o', output)
 
 
 def build(dir_path: str, output: str):
-    subprocess.run(['java', '-jar', f'{ccglobal.LIB_DIR}/APKEditor.jar', 'b', '-f', '-i', dir_path, '-o', output], stderr=subprocess.STDOUT)
+    _execute('b', '-f', '-i', dir_path, '-o', output)
 
 
 def refactor(file: str, output: str):
-    subprocess.run(['java', '-jar', f'{ccglobal.LIB_DIR}/APKEditor.jar', 'x', '-i', file, '-o', output], stderr=subprocess.STDOUT)
+    _execute('x', '-i', file, '-o', output)
+
+
+def _execute(*args: str):
+    if config.APKEDITOR_SERVER and _server.execute(args) is not None:
+        return
+    task.run(['java', *config.APKEDITOR_JVM_OPTIONS, '-jar', _APK_EDITOR, *args], check=False)
@@ -0,0 +1,14 @@
+import hashlib
+import os
+
+import config
+
+
+def write_manifest(image: str, block_size: int = config.FLASH_BLOCK_SIZE):
+    # The first line holds the block size and the size of the last block, followed by the SHA-256 of every block.
+    # The flashing script only counts blocks, so that it never needs byte offsets beyond the 32-bit arithmetic of mksh
+    size = os.path.getsize(image)
+    with open(image, 'rb') as f, open(f'{image}.sha256', 'w', encoding='utf-8', newline='\n') as out:
+        out.write(f'{block_size} {size % block_size or block_size}\n')
+        while block := f.read(block_size):
+            out.write(f'{hashlib.sha256(block).hexdigest()}\n')
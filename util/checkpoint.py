@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import time
+
+import ccglobal
+from util import trace
+
+_CHECKPOINT_JSON = '.checkpoint.json'
+
+
+class Checkpoint:
+    def __init__(self, stages: tuple[str, ...], fingerprint: str, *, resume: bool = False, from_stage: str = None,
+                 restarts: dict[str, tuple[str, str | None]] = None):
+        # Restarts maps a stage that cannot run twice on its own output to the earlier stage a rerun has to begin from, and to
+        # the stage that spoils its input once started, or None if the stage spoils its input itself
+        self._stages = stages
+        self._fingerprint = fingerprint
+        self._current = None
+        self._span: trace.Span | None = None
+        self._completed: dict[str, dict] = {}
+        # Stages that have begun since an earlier stage last ran, finished or not
+        self._started: set[str] = set()
+
+        if resume or from_stage:
+            self._load()
+        # Only the completed stages at the beginning can be skipped, the stages after the first unfinished one depend on it
+        start = from_stage or next((x for x in stages if x not in self._completed), None)
+        while start in (restarts or {}):
+            restart, spoiler = restarts[start]
+            if spoiler and spoiler not in self._started:
+                break
+            ccglobal.log(f'阶段 {start} 无法在已修改的文件上重新执行, 改为从阶段 {restart} 开始')
+            start = restart
+        self._skipped = set(stages[:stages.index(start)] if start else stages)
+        for stage in stages:
+            if stage in self._skipped and stage not in self._completed:
+                raise RuntimeError(f'阶段未完成: {stage}')
+
+    def will_run(self, stage: str):
+        return stage not in self._skipped
+
+    def begin(self, stage: str):
+        self._finish_current()
+        if stage in self._skipped:
+            ccglobal.log(f'跳过已完成的阶段: {stage}')
+            return False
+
+        # Stages after this one are invalid once it runs again
+        for item in self._stages[self._stages.index(stage):]:
+            self._completed.pop(item, None)
+            self._started.discard(item)
+        self._started.add(stage)
+        self._save()
+        self._current = stage
+        self._span = trace.Span(stage, 'stage')
+        return True
+
+    def finish(self):
+        self._finish_current()
+
+    def _finish_current(self):
+        if self._current:
+            self._span.end()
+            self._completed[self._current] = {'fingerprint': self._fingerprint, 'time': int(time.time())}
+            self._save()
+            self._current = None
+
+    def _load(self):
+        if not os.path.isfile(_CHECKPOINT_JSON):
+            return
+        with open(_CHECKPOINT_JSON, 'r', encoding='utf-8') as f:
+            data: dict = json.load(f)
+        self._started = set(data['started'])
+        for stage, marker in data['completed'].items():
+            if marker['fingerprint'] != self._fingerprint:
+                raise RuntimeError(f'构建输入已改变, 无法从阶段恢复: {stage}')
+            self._completed[stage] = marker
+
+    def _save(self):
+        with open(f'{_CHECKPOINT_JSON}.tmp', 'w', encoding='utf-8', newline='') as f:
+            json.dump({'completed': self._completed, 'started': sorted(self._started)}, f, indent=4)
+        os.replace(f'{_CHECKPOINT_JSON}.tmp', _CHECKPOINT_JSON)
+
+
+def fingerprint(*inputs) -> str:
+    def identify(item):
+        if isinstance(item, (list, tuple)):
+            return [identify(x) for x in item]
+        if isinstance(item, str) and os.path.isfile(item):
+            stat = os.stat(item)
+            return [os.path.abspath(item), stat.st_size, stat.st_mtime_ns]
+        return item
+
+    return hashlib.sha256(json.dumps(identify(inputs)).encode('utf-8')).hexdigest()
@@ -0,0 +1,620 @@
+import mmap
+import stat
+import struct
+import zlib
+from typing import BinaryIO, Iterator
+
+_SUPER_OFFSET = 1024
+_MAGIC = 0xe0f5e1e2
+# @formatter:off
+_SUPER_FORMAT_STRING = ('<I'    # magic
+                        'I'     # checksum
+                        'I'     # compat features
+                        'B'     # block size bits
+                        'B'     # superblock extension slots
+                        'H'     # root nid
+                        'Q'     # inode count
+                        'Q'     # build time
+                        'I'     # build time nsec
+                        'I'     # block count
+                        'I'     # meta block address
+                        'I'     # xattr block address
+                        '16s'   # uuid
+                        '16s'   # volume name
+                        'I'     # incompat features
+                        'H'     # available compression algorithms
+                        'H'     # extra devices
+                        'H'     # device slot offset
+                        'B'     # dir block bits
+                        'B'     # xattr prefix count
+                        'I'     # xattr prefix start
+                        'Q')    # packed nid
+_COMPACT_INODE_FORMAT_STRING = ('<H'  # format
+                                'H'   # xattr inline count
+                                'H'   # mode
+                                'H'   # link count
+                                'I'   # size
+                                'I'   # reserved
+                                'I'   # raw block address, compressed blocks, rdev or chunk format
+                                'I'   # inode number
+                                'H'   # uid
+                                'H'   # gid
+                                'I')  # reserved
+_EXTENDED_INODE_FORMAT_STRING = ('<H'   # format
+                                 'H'    # xattr inline count
+                                 'H'    # mode
+                                 'H'    # reserved
+                                 'Q'    # size
+                                 'I'    # raw block address, compressed blocks, rdev or chunk format
+                                 'I'    # inode number
+                                 'I'    # uid
+                                 'I'    # gid
+                                 'Q'    # mtime
+                                 'I'    # mtime nsec
+                                 'I')   # link count
+_MAP_HEADER_FORMAT_STRING = ('<I'   # fragment offset, or reserved and inline data size
+                             'H'    # advise
+                             'B'    # algorithm types of head 1 and head 2
+                             'B')   # cluster bits
+# @formatter:on
+_COMPACT_INODE_SIZE = 32
+_EXTENDED_INODE_SIZE = 64
+_XATTR_HEADER_SIZE = 12
+_DIRENT_FORMAT_STRING = '<QHBx'  # nid, name offset, file type
+_DIRENT_SIZE = struct.calcsize(_DIRENT_FORMAT_STRING)
+_NULL_ADDRESS = 0xffffffff
+_FEATURE_INCOMPAT_ZERO_PADDING = 0x1
+_FEATURE_INCOMPAT_FRAGMENTS = 0x20
+
+_LAYOUT_FLAT_PLAIN = 0
+_LAYOUT_COMPRESSED_FULL = 1
+_LAYOUT_FLAT_INLINE = 2
+_LAYOUT_COMPRESSED_COMPACT = 3
+_LAYOUT_CHUNK_BASED = 4
+_CHUNK_FORMAT_BLOCK_BITS = 0x1f
+_CHUNK_FORMAT_INDEXES = 0x20
+
+_ADVISE_COMPACTED_2B = 0x1
+_ADVISE_BIG_PCLUSTER_1 = 0x2
+_ADVISE_BIG_PCLUSTER_2 = 0x4
+_ADVISE_INLINE_PCLUSTER = 0x8
+_ADVISE_INTERLACED_PCLUSTER = 0x10
+_ADVISE_FRAGMENT_PCLUSTER = 0x20
+_FRAGMENT_INODE_BIT = 7
+
+_LCLUSTER_TYPE_PLAIN = 0
+_LCLUSTER_TYPE_HEAD1 = 1
+_LCLUSTER_TYPE_NONHEAD = 2
+_LCLUSTER_TYPE_HEAD2 = 3
+_LI_D0_CBLKCNT = 1 << 11
+
+_COMPRESSION_LZ4 = 0
+_COMPRESSION_DEFLATE = 2
+# Uncompressed pclusters, not stored on disk
+_COMPRESSION_SHIFTED = -1
+_COMPRESSION_INTERLACED = -2
+
+
+class ErofsInode:
+    def __init__(self, nid: int, offset: int, data: memoryview, build_time: int):
+        self.nid = nid
+        i_format, = struct.unpack_from('<H', data, offset)
+        self.layout = i_format >> 1 & 0x7
+        if i_format & 1:
+            (_, xattr_count, self.mode, _, self.size, self.i_u, self.ino, self.uid, self.gid, self.mtime, _, self.nlink) = \
+                struct.unpack_from(_EXTENDED_INODE_FORMAT_STRING, data, offset)
+            inode_size = _EXTENDED_INODE_SIZE
+        else:
+            (_, xattr_count, self.mode, self.nlink, self.size, _, self.i_u, self.ino, self.uid, self.gid, _) = \
+                struct.unpack_from(_COMPACT_INODE_FORMAT_STRING, data, offset)
+            self.mtime = build_time
+            inode_size = _COMPACT_INODE_SIZE
+        xattr_size = _XATTR_HEADER_SIZE + (xattr_count - 1) * 4 if xattr_count else 0
+        # Inline data, chunk indexes and compression indexes follow the inode and its xattrs
+        self.offset = offset
+        self.data_offset = offset + inode_size + xattr_size
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+
+
+class _Extent:
+    def __init__(self, logical: int, length: int):
+        self.logical = logical
+        self.length = length
+        self.physical = 0
+        self.physical_length = 0
+        self.algorithm = _COMPRESSION_SHIFTED
+        self.fragment = False
+
+
+class _ClusterIndex:
+    def __init__(self):
+        self.lcn = 0
+        self.type = _LCLUSTER_TYPE_PLAIN
+        self.head_type = _LCLUSTER_TYPE_PLAIN
+        self.cluster_offset = 0
+        self.delta = 0
+        self.block = 0
+        self.compressed_blocks = 0
+        self.next_pack_offset = 0
+
+
+class _CompressionInfo:
+    def __init__(self, image: 'ErofsImage', inode: ErofsInode):
+        data = image.data
+        header_offset = _round_up(inode.data_offset, 8)
+        self.header_offset = header_offset
+        self.inline_offset = 0
+        self.inline_size = 0
+        self.fragment_offset = 0
+        self.tail_head_lcn = None
+        self.whole_fragment = False
+
+        fragment_offset, self.advise, algorithm_types, cluster_bits = struct.unpack_from(_MAP_HEADER_FORMAT_STRING, data, header_offset)
+        self.cluster_bits = image.block_bits + (cluster_bits & 0x7)
+        self.algorithms = (algorithm_types & 0xf, algorithm_types >> 4)
+        if cluster_bits >> _FRAGMENT_INODE_BIT:
+            # The whole file is stored in the packed inode
+            self.advise = _ADVISE_FRAGMENT_PCLUSTER
+            self.fragment_offset = struct.unpack_from('<Q', data, header_offset)[0] ^ 1 << 63
+            self.whole_fragment = True
+            return
+
+        if self.advise & _ADVISE_INLINE_PCLUSTER:
+            self.inline_size = fragment_offset >> 16
+            image.map_extent(inode, self, inode.size - 1, find_tail=True)
+        if self.advise & _ADVISE_FRAGMENT_PCLUSTER:
+            self.fragment_offset = fragment_offset
+            image.map_extent(inode, self, inode.size - 1, find_tail=True)
+            # A file within one lcluster is a fragment as a whole
+            self.whole_fragment = self.tail_head_lcn == 0
+
+
+class ErofsImage:
+    # Read-only access straight from the mapped image, files are decompressed extent by extent on demand
+    def __init__(self, file: str):
+        self._file = open(file, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self._mmap)
+
+        header = struct.unpack_from(_SUPER_FORMAT_STRING, self.data, _SUPER_OFFSET)
+        if header[0] != _MAGIC:
+            self.close()
+            raise ValueError(f'Not an erofs image: {file}')
+        self.block_bits = header[3]
+        self.block_size = 1 << self.block_bits
+        self.root_nid = header[5]
+        self._build_time = header[7]
+        self._meta_offset = header[10] << self.block_bits
+        self._features = header[14]
+        self._packed_nid = header[21] if self._features & _FEATURE_INCOMPAT_FRAGMENTS else None
+        self._compression: dict[int, _CompressionInfo] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if hasattr(self, 'data'):
+            self.data.release()
+            self._mmap.close()
+        self._file.close()
+
+    def inode(self, nid: int):
+        return ErofsInode(nid, self._meta_offset + nid * 32, self.data, self._build_time)
+
+    def lookup(self, path: str) -> ErofsInode | None:
+        inode = self.inode(self.root_nid)
+        for name in filter(None, path.replace('\\', '/').split('/')):
+            if not inode.is_dir():
+                return None
+            for entry_name, nid, _ in self._dirents(inode):
+                if entry_name == name:
+                    inode = self.inode(nid)
+                    break
+            else:
+                return None
+        return inode
+
+    def stat(self, path: str):
+        if (inode := self.lookup(path)) is None:
+            raise FileNotFoundError(path)
+        return inode
+
+    def listdir(self, path: str = '/') -> list[str]:
+        inode = self.stat(path)
+        if not inode.is_dir():
+            raise NotADirectoryError(path)
+        return [name for name, _, _ in self._dirents(inode) if name not in ('.', '..')]
+
+    def walk(self, path: str = '/') -> Iterator[tuple[str, list[str], list[str]]]:
+        inode = self.stat(path)
+        dirs, files, children = [], [], []
+        for name, nid, _ in self._dirents(inode):
+            if name in ('.', '..'):
+                continue
+            child = self.inode(nid)
+            if child.is_dir():
+                dirs.append(name)
+                children.append(f'{path.rstrip('/')}/{name}')
+            else:
+                files.append(name)
+        yield path, dirs, files
+        for child in children:
+            yield from self.walk(child)
+
+    def readlink(self, path: str):
+        inode = self.stat(path)
+        if not inode.is_symlink():
+            raise OSError(f'Not a symlink: {path}')
+        return self.read_inode(inode).decode('utf-8', 'surrogateescape')
+
+    def read(self, path: str) -> bytes:
+        return self.read_inode(self.stat(path))
+
+    def read_inode(self, inode: ErofsInode, offset: int = 0, length: int = None) -> bytes:
+        return b''.join(self.iter_inode(inode, offset, length))
+
+    def extract(self, path: str, f: BinaryIO):
+        for data in self.iter_inode(self.stat(path)):
+            f.write(data)
+
+    def iter_inode(self, inode: ErofsInode, offset: int = 0, length: int = None) -> Iterator[bytes | memoryview]:
+        # Flat data is yielded as views of the mapped image, they are valid until the image is closed
+        end = inode.size if length is None else min(inode.size, offset + length)
+        if offset >= end:
+            return
+        if inode.layout in (_LAYOUT_FLAT_PLAIN, _LAYOUT_FLAT_INLINE):
+            yield from self._iter_flat(inode, offset, end)
+        elif inode.layout == _LAYOUT_CHUNK_BASED:
+            yield from self._iter_chunks(inode, offset, end)
+        elif inode.layout in (_LAYOUT_COMPRESSED_FULL, _LAYOUT_COMPRESSED_COMPACT):
+            yield from self._iter_compressed(inode, offset, end)
+        else:
+            raise ValueError(f'Unsupported data layout {inode.layout} of nid {inode.nid}')
+
+    def _dirents(self, inode: ErofsInode) -> Iterator[tuple[str, int, int]]:
+        data = self.read_inode(inode)
+        for block_start in range(0, len(data), self.block_size):
+            block = data[block_start:block_start + self.block_size]
+            count = struct.unpack_from(_DIRENT_FORMAT_STRING, block)[1] // _DIRENT_SIZE
+            entries = [struct.unpack_from(_DIRENT_FORMAT_STRING, block, i * _DIRENT_SIZE) for i in range(count)]
+            for i, (nid, name_offset, file_type) in enumerate(entries):
+                # The last name of a block runs until the end of the block or a null byte
+                name_end = entries[i + 1][1] if i + 1 < count else len(block)
+                name = block[name_offset:name_end]
+                if i + 1 == count:
+                    name = name.split(b'\0', 1)[0]
+                yield name.decode('utf-8', 'surrogateescape'), nid, file_type
+
+    def _iter_flat(self, inode: ErofsInode, offset: int, end: int):
+        block_count = -(-inode.size // self.block_size)
+        # The last block of an inline inode is stored right after the inode
+        tail = inode.layout == _LAYOUT_FLAT_INLINE
+        plain_size = min(inode.size, (block_count - tail) * self.block_size)
+        if offset < plain_size:
+            start = inode.i_u << self.block_bits
+            yield self.data[start + offset:start + min(end, plain_size)]
+        if tail and end > plain_size:
+            start = inode.data_offset - plain_size
+            yield self.data[start + max(offset, plain_size):start + end]
+
+    def _iter_chunks(self, inode: ErofsInode, offset: int, end: int):
+        chunk_format = inode.i_u & 0xffff
+        chunk_size = self.block_size << (chunk_format & _CHUNK_FORMAT_BLOCK_BITS)
+        if chunk_format & _CHUNK_FORMAT_INDEXES:
+            # Indexes of 8 bytes: advise, device id and block address
+            unit, address_offset = 8, 4
+        else:
+            unit, address_offset = 4, 0
+        table_offset = _round_up(inode.data_offset, unit)
+        for i in range(offset // chunk_size, -(-end // chunk_size)):
+            chunk_start = max(offset, i * chunk_size) - i * chunk_size
+            chunk_end = min(end, (i + 1) * chunk_size) - i * chunk_size
+            block, = struct.unpack_from('<I', self.data, table_offset + i * unit + address_offset)
+            if chunk_format & _CHUNK_FORMAT_INDEXES and struct.unpack_from('<H', self.data, table_offset + i * unit + 2)[0]:
+                raise ValueError(f'Extra devices are not supported, nid {inode.nid}')
+            if block == _NULL_ADDRESS:
+                yield bytes(chunk_end - chunk_start)
+            else:
+                start = block << self.block_bits
+                yield self.data[start + chunk_start:start + chunk_end]
+
+    def _iter_compressed(self, inode: ErofsInode, offset: int, end: int):
+        info = self._compression_info(inode)
+        position = offset
+        while position < end:
+            if info.whole_fragment:
+                extent = _Extent(0, inode.size)
+                extent.fragment = True
+            else:
+                extent = self.map_extent(inode, info, position)
+            if extent.length <= 0:
+                raise ValueError(f'Empty extent at {position} of nid {inode.nid}')
+            data = self._decompress(inode, info, extent, position, min(end, extent.logical + extent.length))
+            yield data
+            position = extent.logical + extent.length
+
+    def _compression_info(self, inode: ErofsInode):
+        if inode.nid not in self._compression:
+            self._compression[inode.nid] = _CompressionInfo(self, inode)
+        return self._compression[inode.nid]
+
+    def map_extent(self, inode: ErofsInode, info: _CompressionInfo, position: int, *, find_tail=False):
+        # Mirrors the extent mapping of erofs: find the head lcluster of the pcluster holding the position,
+        # the extent ends at the start of the next pcluster
+        cluster_bits = info.cluster_bits
+        initial_lcn = position >> cluster_bits
+        end_offset = position & (1 << cluster_bits) - 1
+        index = _ClusterIndex()
+        self._load_cluster(inode, info, index, initial_lcn)
+        if find_tail and info.advise & _ADVISE_INLINE_PCLUSTER:
+            info.inline_offset = index.next_pack_offset
+
+        end = index.lcn + 1 << cluster_bits
+        if index.type != _LCLUSTER_TYPE_NONHEAD and end_offset >= index.cluster_offset:
+            index.head_type = index.type
+            logical = index.lcn << cluster_bits | index.cluster_offset
+            if info.advise & _ADVISE_INLINE_PCLUSTER and end > inode.size:
+                end = inode.size
+        else:
+            if index.type != _LCLUSTER_TYPE_NONHEAD:
+                if index.lcn == 0:
+                    raise ValueError(f'Invalid logical cluster 0 of nid {inode.nid}')
+                end = index.lcn << cluster_bits | index.cluster_offset
+                index.delta = 1
+            logical = self._look_back(inode, info, index, index.delta)
+
+        extent = _Extent(logical, end - logical)
+        if find_tail:
+            info.tail_head_lcn = index.lcn
+            if info.advise & _ADVISE_FRAGMENT_PCLUSTER and inode.layout == _LAYOUT_COMPRESSED_FULL:
+                info.fragment_offset |= index.block << 32
+
+        if info.advise & _ADVISE_INLINE_PCLUSTER and index.lcn == info.tail_head_lcn:
+            extent.physical = info.inline_offset
+            extent.physical_length = info.inline_size
+        elif info.advise & _ADVISE_FRAGMENT_PCLUSTER and index.lcn == info.tail_head_lcn:
+            extent.fragment = True
+        else:
+            extent.physical = index.block << self.block_bits
+            extent.physical_length = self._compressed_length(inode, info, index, initial_lcn)
+
+        if index.head_type == _LCLUSTER_TYPE_PLAIN:
+            if extent.length > extent.physical_length and not extent.fragment:
+                raise ValueError(f'Invalid plain extent of nid {inode.nid}')
+            extent.algorithm = _COMPRESSION_INTERLACED if info.advise & _ADVISE_INTERLACED_PCLUSTER else _COMPRESSION_SHIFTED
+        else:
+            extent.algorithm = info.algorithms[1 if index.head_type == _LCLUSTER_TYPE_HEAD2 else 0]
+        return extent
+
+    def _look_back(self, inode: ErofsInode, info: _CompressionInfo, index: _ClusterIndex, distance: int):
+        while True:
+            if distance > index.lcn:
+                raise ValueError(f'Bogus look back distance of nid {inode.nid}')
+            self._load_cluster(inode, info, index, index.lcn - distance)
+            if index.type != _LCLUSTER_TYPE_NONHEAD:
+                index.head_type = index.type
+                return index.lcn << info.cluster_bits | index.cluster_offset
+            if index.delta == 0:
+                raise ValueError(f'Invalid look back distance 0 of nid {inode.nid}')
+            distance = index.delta
+
+    def _compressed_length(self, inode: ErofsInode, info: _CompressionInfo, index: _ClusterIndex, initial_lcn: int):
+        if (index.head_type in (_LCLUSTER_TYPE_PLAIN, _LCLUSTER_TYPE_HEAD1) and not info.advise & _ADVISE_BIG_PCLUSTER_1) or \
+                (index.head_type == _LCLUSTER_TYPE_HEAD2 and not info.advise & _ADVISE_BIG_PCLUSTER_2):
+            return 1 << info.cluster_bits
+
+        if not index.compressed_blocks:
+            lcn = index.lcn + 1
+            self._load_cluster(inode, info, index, lcn)
+            if index.type != _LCLUSTER_TYPE_NONHEAD:
+                # A pcluster of one lcluster has no block count
+                index.compressed_blocks = 1 << info.cluster_bits - self.block_bits
+            elif index.delta != 1 or not index.compressed_blocks:
+                raise ValueError(f'Missing compressed block count of nid {inode.nid}')
+        return index.compressed_blocks << self.block_bits
+
+    def _load_cluster(self, inode: ErofsInode, info: _CompressionInfo, index: _ClusterIndex, lcn: int):
+        if inode.layout == _LAYOUT_COMPRESSED_FULL:
+            self._load_full_index(info, index, lcn)
+        else:
+            self._load_compact_index(inode, info, index, lcn)
+
+    def _load_full_index(self, info: _CompressionInfo, index: _ClusterIndex, lcn: int):
+        # A full index is 8 bytes: advise, cluster offset and a block address or two deltas
+        position = info.header_offset + 8 + 8 + lcn * 8
+        advise, cluster_offset, block = struct.unpack_from('<HHI', self.data, position)
+        index.lcn = lcn
+        index.next_pack_offset = position + 8
+        index.type = advise & 0x3
+        if index.type == _LCLUSTER_TYPE_NONHEAD:
+            index.cluster_offset = 1 << info.cluster_bits
+            index.delta = block & 0xffff
+            if index.delta & _LI_D0_CBLKCNT:
+                index.compressed_blocks = index.delta & ~_LI_D0_CBLKCNT
+                index.delta = 1
+        else:
+            index.cluster_offset = cluster_offset
+            index.block = block
+
+    def _load_compact_index(self, inode: ErofsInode, info: _CompressionInfo, index: _ClusterIndex, lcn: int):
+        # Compact indexes are packed in groups sharing one block address: 4 bytes per lcluster up to a 32 byte
+        # boundary, 2 bytes per lcluster in packs of 16 if enabled, then 4 bytes per lcluster for the rest
+        base = info.header_offset + 8
+        total = -(-inode.size // self.block_size)
+        if lcn >= total:
+            raise ValueError(f'Logical cluster {lcn} out of range of nid {inode.nid}')
+        initial_4b = (32 - base % 32) // 4 % 8
+        compacted_2b = (total - initial_4b) // 16 * 16 if info.advise & _ADVISE_COMPACTED_2B and initial_4b < total else 0
+
+        index.lcn = lcn
+        position = base
+        if lcn < initial_4b:
+            shift = 2
+        else:
+            position += initial_4b * 4
+            lcn -= initial_4b
+            if lcn < compacted_2b:
+                shift = 1
+            else:
+                position += compacted_2b * 2
+                lcn -= compacted_2b
+                shift = 2
+        position += lcn << shift
+        self._unpack_compact_index(info, index, shift, position)
+
+    def _unpack_compact_index(self, info: _CompressionInfo, index: _ClusterIndex, shift: int, position: int):
+        cluster_bits = info.cluster_bits
+        if shift == 2 and cluster_bits <= 14:
+            count = 2
+        elif shift == 1 and cluster_bits <= 12:
+            count = 16
+        else:
+            raise ValueError('Unsupported compact index')
+        pack_size = count << shift
+        pack = position - position % pack_size
+        index.next_pack_offset = pack + pack_size
+        i = (position - pack) >> shift
+        lo_bits = max(cluster_bits, 12)
+        encode_bits = (pack_size - 4) * 8 // count
+        big_pcluster = info.advise & _ADVISE_BIG_PCLUSTER_1
+
+        def decode(n: int):
+            bit = encode_bits * n
+            value = int.from_bytes(self.data[pack + bit // 8:pack + bit // 8 + 4], 'little') >> bit % 8
+            return value & (1 << lo_bits) - 1, value >> lo_bits & 0x3
+
+        lo, index.type = decode(i)
+        if index.type == _LCLUSTER_TYPE_NONHEAD:
+            index.cluster_offset = 1 << cluster_bits
+            if lo & _LI_D0_CBLKCNT:
+                index.compressed_blocks = lo & ~_LI_D0_CBLKCNT
+                index.delta = 1
+            elif i + 1 != count:
+                index.delta = lo
+            else:
+                # The last lcluster of a pack stores delta[1], delta[0] comes from the previous one
+                lo, previous_type = decode(i - 1)
+                if previous_type != _LCLUSTER_TYPE_NONHEAD:
+                    lo = 0
+                elif lo & _LI_D0_CBLKCNT:
+                    lo = 1
+                index.delta = lo + 1
+            return
+
+        index.cluster_offset = lo
+        index.delta = 0
+        # The pack stores the block address of its first pcluster, count the pclusters before this one
+        blocks = 0
+        if not big_pcluster:
+            blocks = 1
+            while i > 0:
+                i -= 1
+                lo, previous_type = decode(i)
+                if previous_type == _LCLUSTER_TYPE_NONHEAD:
+                    i -= lo
+                if i >= 0:
+                    blocks += 1
+        else:
+            while i > 0:
+                i -= 1
+                lo, previous_type = decode(i)
+                if previous_type == _LCLUSTER_TYPE_NONHEAD:
+                    if lo & _LI_D0_CBLKCNT:
+                        i -= 1
+                        blocks += lo & ~_LI_D0_CBLKCNT
+                        continue
+                    if lo <= 1:
+                        raise ValueError('Invalid compact index of big pcluster')
+                    i -= lo - 2
+                    continue
+                blocks += 1
+        index.block = struct.unpack_from('<I', self.data, pack + pack_size - 4)[0] + blocks
+
+    def _decompress(self, inode: ErofsInode, info: _CompressionInfo, extent: _Extent, start: int, end: int):
+        # Only the part of the extent up to the end is decoded, then the part before the start is skipped
+        skip = start - extent.logical
+        length = end - extent.logical
+        if extent.fragment:
+            return self.read_inode(self.inode(self._packed_nid), info.fragment_offset + skip, length - skip)
+
+        source = self.data[extent.physical:extent.physical + extent.physical_length]
+        if extent.algorithm == _COMPRESSION_SHIFTED:
+            return source[skip:length]
+        if extent.algorithm == _COMPRESSION_INTERLACED:
+            head = extent.logical % self.block_size
+            right = min(self.block_size - head, extent.length)
+            return (bytes(source[head:head + right]) + bytes(source[:extent.length - right]))[skip:length]
+
+        # Compressed data is aligned to the end of the pcluster, the leading zeros in its first block are padding
+        margin = 0
+        if self._features & _FEATURE_INCOMPAT_ZERO_PADDING or extent.algorithm != _COMPRESSION_LZ4:
+            while margin < min(len(source), self.block_size) and source[margin] == 0:
+                margin += 1
+        if extent.algorithm == _COMPRESSION_LZ4:
+            return lz4_decompress(source[margin:], length)[skip:]
+        if extent.algorithm == _COMPRESSION_DEFLATE:
+            return zlib.decompressobj(-15).decompress(source[margin:], length)[skip:]
+        raise ValueError(f'Unsupported compression algorithm {extent.algorithm} of nid {inode.nid}')
+
+
+def lz4_decompress(source: bytes | memoryview, size: int) -> bytes:
+    # Decodes an lz4 block until the output reaches the size, a pcluster may hold more than the extent needs
+    output = bytearray()
+    position = 0
+    length = len(source)
+    while position < length:
+        token = source[position]
+        position += 1
+        literal_length = token >> 4
+        if literal_length == 15:
+            while True:
+                byte = source[position]
+                position += 1
+                literal_length += byte
+                if byte != 255:
+                    break
+        output += source[position:position + literal_length]
+        position += literal_length
+        if len(output) >= size or position >= length:
+            break
+
+        match_offset = source[position] | source[position + 1] << 8
+        position += 2
+        match_length = token & 0xf
+        if match_length == 15:
+            while True:
+                byte = source[position]
+                position += 1
+                match_length += byte
+                if byte != 255:
+                    break
+        match_length += 4
+        start = len(output) - match_offset
+        if match_offset == 0 or start < 0:
+            raise ValueError('Invalid lz4 match offset')
+        if match_offset >= match_length:
+            output += output[start:start + match_length]
+        else:
+            # Overlapping match repeats the last bytes
+            pattern = output[start:]
+            output += (pattern * (match_length // match_offset + 1))[:match_length]
+    if len(output) < size:
+        raise ValueError('Truncated lz4 data')
+    return bytes(output[:size])
+
+
+def _round_up(value: int, alignment: int):
+    return -(-value // alignment) * alignment
@@ -0,0 +1,114 @@
+import os
+import re
+import shutil
+
+import ccglobal
+
+_DEFAULT_CONTEXT = 'u:object_r:system_file:s0'
+_DIR_MODE = '0 0 0755'
+_FILE_MODE = '0 0 0644'
+_REGEX_META = re.compile(r'[.^$?*+|\[\](){}]')
+_ESCAPE = re.compile(r'\\(.)')
+
+
+class _Node:
+    def __init__(self, path: str, is_dir: bool):
+        self.path = path
+        self.is_dir = is_dir
+        self.children: list[_Node] = []
+        self.context: str | None = None
+        # Whole subtree shares the context of this node
+        self.uniform = True
+
+
+def sync(partition: str, out_dir: str = '.', config_dir: str = None):
+    # Brings fs_config and file_contexts in line with the unpacked tree: entries of removed files are dropped,
+    # added files get entries, and subtrees sharing one label are written as a single prefix rule
+    out_dir = os.path.relpath(out_dir)
+    config_dir = config_dir or f'{out_dir}/config'
+    fs_config_file = f'{config_dir}/{partition}_fs_config'
+    file_contexts_file = f'{config_dir}/{partition}_file_contexts'
+    if not os.path.isfile(fs_config_file):
+        return
+    # The files are always rebuilt from the extracted ones, so that a sync can run again on its own output
+    for file in (fs_config_file, file_contexts_file):
+        if not os.path.isfile(f'{file}.orig'):
+            shutil.copy(file, f'{file}.orig.tmp')
+            os.replace(f'{file}.orig.tmp', f'{file}.orig')
+
+    root = _Node(partition, True)
+    paths = {}
+    _scan(f'{out_dir}/{partition}', root, paths)
+
+    modes = {}
+    with open(f'{fs_config_file}.orig', 'r', encoding='utf-8') as f:
+        for line in f:
+            path, _, mode = line.rstrip('\n').partition(' ')
+            modes[path] = mode
+    removed = sum(1 for x in modes if _is_stale(x, partition, paths))
+    added = [x for x in paths if x not in modes]
+    for path in added:
+        modes[path] = _DIR_MODE if paths[path].is_dir else _FILE_MODE
+    with open(fs_config_file, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(f'{path} {mode}\n' for path, mode in modes.items() if not _is_stale(path, partition, paths))
+
+    # Literal rules are folded into the tree, rules with patterns are kept as they are
+    rules = []
+    contexts = {}
+    with open(f'{file_contexts_file}.orig', 'r', encoding='utf-8') as f:
+        for line in f:
+            if not (line := line.strip()):
+                continue
+            pattern, _, context = line.partition(' ')
+            path = _ESCAPE.sub(r'\1', pattern)
+            if _REGEX_META.search(_ESCAPE.sub('', pattern)) or not _in_partition(path[1:], partition):
+                rules.append(line)
+            else:
+                contexts[path[1:]] = context.strip()
+    _resolve(root, contexts, contexts.get(partition, _DEFAULT_CONTEXT))
+    literal_count = len(contexts)
+    _emit(root, rules)
+    with open(file_contexts_file, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(f'{x}\n' for x in rules)
+
+    ccglobal.log(f'同步文件属性: {partition}, 新增 {len(added)} 项, 删除 {removed} 项, 安全上下文 {literal_count} -> {len(rules)} 条')
+
+
+def _scan(dir_path: str, node: _Node, paths: dict[str, _Node]):
+    paths[node.path] = node
+    with os.scandir(dir_path) as entries:
+        for entry in sorted(entries, key=lambda x: x.name):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            child = _Node(f'{node.path}/{entry.name}', is_dir)
+            node.children.append(child)
+            if is_dir:
+                _scan(entry.path, child, paths)
+            else:
+                paths[child.path] = child
+
+
+def _in_partition(path: str, partition: str):
+    return path == partition or path.startswith(f'{partition}/')
+
+
+def _is_stale(path: str, partition: str, paths: dict[str, _Node]):
+    # Only entries inside the partition are checked, anything else is left to mkfs.erofs
+    return _in_partition(path, partition) and path not in paths
+
+
+def _resolve(node: _Node, contexts: dict[str, str], inherited: str):
+    # Files without a label take the one of their directory
+    node.context = contexts.get(node.path, inherited)
+    for child in node.children:
+        _resolve(child, contexts, node.context)
+        node.uniform &= child.uniform and child.context == node.context
+
+
+def _emit(node: _Node, rules: list[str]):
+    pattern = f'/{re.escape(node.path)}'
+    if node.is_dir and node.uniform and node.children:
+        rules.append(f'{pattern}(/.*)? {node.context}')
+        return
+    rules.append(f'{pattern} {node.context}')
+    for child in node.children:
+        _emit(child, rules)
@@ -1,17 +1,19 @@
-import io
+import json
 import os
-import re
 import shutil
-import subprocess
 from enum import Enum, auto
 from pathlib import Path
 
 import ccglobal
+import config
+from util import sparseimg, task
 
 _MAGISKBOOT = f'{ccglobal.LIB_DIR}/magiskboot.exe'
 _EXTRACT_EROFS = f'{ccglobal.LIB_DIR}/extract.erofs.exe'
 _MKFS_EROFS = f'{ccglobal.LIB_DIR}/mkfs.erofs.exe'
 _E2FS_TOOL = f'{ccglobal.LIB_DIR}/e2fstool.exe'
+# Files kept in config/ for each partition, partition names may prefix each other, so they are listed one by one
+_CONFIG_SUFFIXES = ('fs_type', 'fs_config', 'file_contexts', 'fs_config.orig', 'file_contexts.orig', 'manifest.json')
 
 
 class FileSystem(Enum):
@@ -30,95 +32,112 @@ _FS_TYPES = (
 
 
 def filesystem(file: str) -> FileSystem | None:
-    with open(file, 'rb') as f:
-        for fs, offset, magic in _FS_TYPES:
-            f.seek(offset, os.SEEK_SET)
-            buf = f.read(len(magic))
-            if buf == magic:
-                return fs
+    head = sparseimg.read_head(file, max(offset + len(magic) for _, offset, magic in _FS_TYPES))
+    for fs, offset, magic in _FS_TYPES:
+        if head[offset:offset + len(magic)] == magic:
+            return fs
     return None
 
 
+def extract_erofs(file: str, out_dir: str):
+    task.run([_EXTRACT_EROFS, '-x', '-i', file, '-o', out_dir])
+
+
 def unpack(file: str, partition: str, out_dir: str = '.'):
     out_dir = os.path.relpath(out_dir)
     Path(out_dir).joinpath('config').mkdir(exist_ok=True)
+    # A rerun of the stage starts from a clean tree, not from what the later stages left behind
+    if os.path.isdir(f'{out_dir}/{partition}'):
+        shutil.rmtree(f'{out_dir}/{partition}')
+    for suffix in _CONFIG_SUFFIXES:
+        Path(f'{out_dir}/config/{partition}_{suffix}').unlink(True)
 
     fs_type = filesystem(file)
     with open(f'{out_dir}/config/{partition}_fs_type', 'w', encoding='utf-8') as f:
         f.write(fs_type.name)
 
+    raw_file = None
+    if sparseimg.is_sparse(file):
+        ccglobal.log(f'转换稀疏镜像: {file}')
+        raw_file = f'{file}.raw'
+        sparseimg.unsparse(file, raw_file)
+        file = raw_file
+
     ccglobal.log(f'提取镜像: {file}, 格式: {fs_type.name}')
+    try:
+        _extract(file, partition, out_dir, fs_type)
+        # Images of other file systems are not extracted, without a manifest they always count as modified
+        if os.path.isdir(f'{out_dir}/{partition}'):
+            with open(f'{out_dir}/config/{partition}_manifest.json', 'w', encoding='utf-8', newline='') as f:
+                json.dump(_tree_manifest(f'{out_dir}/{partition}'), f)
+    finally:
+        if raw_file:
+            os.remove(raw_file)
+
+
+def _extract(file: str, partition: str, out_dir: str, fs_type: FileSystem):
     match fs_type:
         case FileSystem.EROFS:
-            subprocess.run([_EXTRACT_EROFS, '-x', '-i', file, '-o', out_dir], check=True)
+            extract_erofs(file, out_dir)
         case FileSystem.EXT4:
-            subprocess.run([_E2FS_TOOL, file, f'{out_dir}/{partition}'], check=True)
+            task.run([_E2FS_TOOL, file, f'{out_dir}/{partition}'])
         case FileSystem.BOOT:
-            cwd = os.getcwd()
             partition_dir = f'{out_dir}/{partition}'
             os.mkdir(partition_dir)
             shutil.copy(file, f'{partition_dir}/{partition}.img')
-            os.chdir(partition_dir)
-            subprocess.run([_MAGISKBOOT, 'unpack', f'{partition}.img'], check=True)
-            os.chdir(cwd)
+            task.run([_MAGISKBOOT, 'unpack', f'{partition}.img'], cwd=partition_dir)
 
 
-def repack(file: str, partition: str, out_dir: str = '.'):
+def repack(file: str, partition: str, out_dir: str = '.', compression: tuple[str, ...] = None, config_dir: str = None):
     out_dir = os.path.relpath(out_dir)
+    config_dir = config_dir or f'{out_dir}/config'
+    if compression is None:
+        compression = config.EROFS_PARTITION_COMPRESSION.get(partition, config.EROFS_COMPRESSION)
 
-    with open(f'{out_dir}/config/{partition}_fs_type', 'r', encoding='utf-8') as f:
+    with open(f'{config_dir}/{partition}_fs_type', 'r', encoding='utf-8') as f:
         fs_type = FileSystem[f.read()]
 
     ccglobal.log(f'打包镜像: {file}, 格式: {fs_type.name}')
     match fs_type:
         case FileSystem.EROFS:
-            subprocess.run([_MKFS_EROFS, '-zlz4hc,1', '-T', '1230768000', '--mount-point', f'/{partition}', '--fs-config-file', f'{out_dir}/config/{partition}_fs_config',
-                            '--file-contexts', f'{out_dir}/config/{partition}_file_contexts', file, f'{out_dir}/{partition}'], check=True)
+            task.run([_MKFS_EROFS, *compression, '-T', '1230768000', '--mount-point', f'/{partition}', '--fs-config-file', f'{config_dir}/{partition}_fs_config',
+                      '--file-contexts', f'{config_dir}/{partition}_file_contexts', file, f'{out_dir}/{partition}'])
         case FileSystem.BOOT:
-            cwd = os.getcwd()
-            os.chdir(f'{out_dir}/{partition}')
-            subprocess.run([_MAGISKBOOT, 'repack', f'{partition}.img', f'{cwd}/{file}'], check=True)
-            os.chdir(cwd)
+            task.run([_MAGISKBOOT, 'repack', f'{partition}.img', os.path.abspath(file)], cwd=f'{out_dir}/{partition}')
 
 
-def sync_app_perm_and_context(partition: str, out_dir: str = '.'):
+def is_modified(partition: str, out_dir: str = '.'):
+    # Compares the unpacked tree with the manifest recorded at unpack time
     out_dir = os.path.relpath(out_dir)
-
-    if partition == 'system':
-        app = f'system/system/app'
-        priv_app = f'system/system/priv-app'
-    else:
-        app = f'{partition}/app'
-        priv_app = f'{partition}/priv-app'
-    if not os.path.exists(f'{out_dir}/{app}') and not os.path.exists(f'{out_dir}/{priv_app}'):
-        return
-
-    existing = set()
-    with open(f'{out_dir}/config/{partition}_fs_config', 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.startswith(app) or line.startswith(priv_app):
-                existing.add(line.split(' ')[0])
-
-    mode_output = io.StringIO()
-    context_output = io.StringIO()
-    for folder in (app, priv_app):
-        for root, dirs, files in os.walk(f'{out_dir}/{folder}'):
-            for i in dirs:
-                i = os.path.join(os.path.relpath(root), i).replace('\\', '/')
-                if i not in existing:
-                    mode_output.write(f'{i} 0 0 0755\n')
-                    context_output.write(f'/{re.escape(i)} u:object_r:system_file:s0\n')
-            for i in files:
-                i = os.path.join(os.path.relpath(root), i).replace('\\', '/')
-                if i not in existing:
-                    mode_output.write(f'{i} 0 0 0644\n')
-                    context_output.write(f'/{re.escape(i)} u:object_r:system_file:s0\n')
-
-    if partition == 'product':
-        mode_output.write(f'product/UpdatedApp.json 0 0 0644\n')
-        context_output.write('/product/UpdatedApp\\.json u:object_r:system_file:s0\n')
-
-    with open(f'{out_dir}/config/{partition}_fs_config', 'a', encoding='utf-8') as f:
-        f.write(mode_output.getvalue())
-    with open(f'{out_dir}/config/{partition}_file_contexts', 'a', encoding='utf-8') as f:
-        f.write(context_output.getvalue())
+    manifest_file = f'{out_dir}/config/{partition}_manifest.json'
+    if not os.path.isfile(manifest_file) or not os.path.isdir(f'{out_dir}/{partition}'):
+        return True
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        try:
+            manifest = json.load(f)
+        except json.decoder.JSONDecodeError:
+            return True
+    return manifest != _tree_manifest(f'{out_dir}/{partition}')
+
+
+def _tree_manifest(dir_path: str, manifest: dict[str, list[int]] = None, prefix: str = ''):
+    # Relative path to (size, mtime, mode) of every file and directory
+    manifest = {} if manifest is None else manifest
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            stat = entry.stat(follow_symlinks=False)
+            path = f'{prefix}{entry.name}'
+            manifest[path] = [stat.st_size, stat.st_mtime_ns, stat.st_mode]
+            if entry.is_dir(follow_symlinks=False):
+                _tree_manifest(entry.path, manifest, f'{path}/')
+    return manifest
+
+
+def dir_size(dir_path: str):
+    size = 0
+    for entry in os.scandir(dir_path):
+        if entry.is_dir(follow_symlinks=False):
+            size += dir_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
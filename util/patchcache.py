@@ -0,0 +1,154 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import types
+from glob import iglob
+from pathlib import Path
+from typing import Callable
+
+import ccglobal
+import config
+
+_CACHE_DIR = f'{ccglobal.CACHE_DIR}/patch'
+_MANIFEST_JSON = 'manifest.json'
+
+
+class CachedPatch:
+    def __init__(self, func: Callable, file: str, paths: tuple[str, ...]):
+        self.func = func
+        self.file = file
+        self.paths = paths
+
+    def __call__(self):
+        if not os.path.isfile(self.file):
+            return self.func()
+
+        entry = Path(_CACHE_DIR).joinpath(self._key())
+        if entry.is_dir():
+            ccglobal.log(f'使用缓存: {self.file}')
+            self._restore(entry)
+            return
+
+        before = _snapshot(self.paths)
+        self.func()
+        after = _snapshot(self.paths)
+        changed = [x for x, stat in after.items() if before.get(x) != stat]
+        deleted = [x for x in before if x not in after]
+        if changed or deleted:
+            self._store(entry, changed, deleted)
+
+    def _key(self):
+        digest = hashlib.sha256()
+        digest.update(_file_hash(self.file).encode('utf-8'))
+        digest.update(_function_source(self.func).encode('utf-8'))
+        digest.update(_environment_fingerprint().encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _store(entry: Path, changed: list[str], deleted: list[str]):
+        tmp_entry = entry.with_name(f'{entry.name}.{os.getpid()}.tmp')
+        for file in changed:
+            dst = tmp_entry.joinpath('files', file)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(file, dst)
+        with open(tmp_entry.joinpath(_MANIFEST_JSON), 'w', encoding='utf-8', newline='') as f:
+            json.dump({'changed': changed, 'deleted': deleted}, f, indent=4)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another process has stored the same entry
+            shutil.rmtree(tmp_entry)
+
+    @staticmethod
+    def _restore(entry: Path):
+        manifest = entry.joinpath(_MANIFEST_JSON)
+        with open(manifest, 'r', encoding='utf-8') as f:
+            data: dict = json.load(f)
+        for file in data['deleted']:
+            if os.path.isfile(file):
+                os.remove(file)
+        for file in data['changed']:
+            Path(file).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(entry.joinpath('files', file), file)
+        # The modification time of manifest is the last used time of entry
+        os.utime(manifest)
+
+
+def evict():
+    if not os.path.isdir(_CACHE_DIR):
+        return
+    entries = []
+    for entry in os.scandir(_CACHE_DIR):
+        manifest = f'{entry.path}/{_MANIFEST_JSON}'
+        if entry.is_dir() and os.path.isfile(manifest):
+            size = sum(os.path.getsize(x) for x in iglob(f'{entry.path}/**', recursive=True) if os.path.isfile(x))
+            entries.append((os.path.getmtime(manifest), size, entry.path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, path in sorted(entries):
+        if total <= config.PATCH_CACHE_SIZE:
+            break
+        ccglobal.log(f'清除缓存: {os.path.basename(path)}')
+        shutil.rmtree(path)
+        total -= size
+
+
+def _snapshot(paths: tuple[str, ...]):
+    files = {}
+    for path in paths:
+        for root, _, names in os.walk(path):
+            for name in names:
+                file = os.path.join(root, name).replace('\\', '/')
+                stat = os.stat(file)
+                files[file] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return files
+
+
+def _file_hash(file: str):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _function_source(func: Callable):
+    # Source of the patch and of the module level helpers and constants it uses, directly or through other helpers
+    sources = []
+    seen = set()
+    pending = [func]
+    while pending:
+        item = pending.pop()
+        sources.append(inspect.getsource(item))
+        codes = [item.__code__]
+        while codes:
+            code = codes.pop()
+            codes += [x for x in code.co_consts if isinstance(x, types.CodeType)]
+            for name in code.co_names:
+                if name in seen or name not in func.__globals__:
+                    continue
+                seen.add(name)
+                value = func.__globals__[name]
+                if isinstance(value, types.FunctionType) and value.__module__ == func.__module__:
+                    pending.append(value)
+                elif isinstance(value, (str, int, float, tuple, list, dict, set, frozenset)):
+                    sources.append(f'{name} = {value!r}')
+    return '\n'.join(sources)
+
+
+@functools.cache
+def _environment_fingerprint():
+    # Code of the patch engine and the tools around it, config, injected smali and the APKEditor version also affect the output
+    digest = hashlib.sha256()
+    files = sorted(iglob(f'{ccglobal.MISC_DIR}/smali/*')) + sorted(iglob(f'{sys.path[0]}/build/*.py')) + \
+        sorted(iglob(f'{sys.path[0]}/util/*.py')) + [f'{sys.path[0]}/config.py']
+    for file in files:
+        digest.update(_file_hash(file).encode('utf-8'))
+    apk_editor = f'{ccglobal.LIB_DIR}/APKEditor.jar'
+    if os.path.isfile(apk_editor):
+        digest.update(str(os.path.getsize(apk_editor)).encode('utf-8'))
+    return digest.hexdigest()
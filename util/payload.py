@@ -0,0 +1,76 @@
+import struct
+import zipfile
+from typing import BinaryIO
+
+_MAGIC = b'CrAU'
+# @formatter:off
+_HEADER_FORMAT_STRING = ('>4s'  # magic
+                         'Q'    # file format version
+                         'Q')   # manifest size
+# @formatter:on
+_MANIFEST_PARTITIONS_FIELD = 13
+_PARTITION_NAME_FIELD = 1
+
+
+def partitions(file: str) -> list[str]:
+    if zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file, 'r') as zip_file, zip_file.open('payload.bin', 'r') as f:
+            manifest = _read_manifest(f)
+    else:
+        with open(file, 'rb') as f:
+            manifest = _read_manifest(f)
+
+    names = []
+    for number, value in _iter_fields(manifest):
+        if number != _MANIFEST_PARTITIONS_FIELD:
+            continue
+        for sub_number, sub_value in _iter_fields(value):
+            if sub_number == _PARTITION_NAME_FIELD:
+                names.append(sub_value.decode('utf-8'))
+                break
+    return names
+
+
+def _read_manifest(f: BinaryIO):
+    header = f.read(struct.calcsize(_HEADER_FORMAT_STRING))
+    magic, version, manifest_size = struct.unpack(_HEADER_FORMAT_STRING, header)
+    if magic != _MAGIC:
+        raise ValueError('Invalid payload magic')
+    if version >= 2:
+        # Skip metadata signature size
+        f.read(4)
+    return f.read(manifest_size)
+
+
+def _iter_fields(data: bytes):
+    # Only decode the top level of a protobuf message, values of wire type LEN are returned as raw bytes
+    pos = 0
+    length = len(data)
+    while pos < length:
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x7
+        match wire_type:
+            case 0:
+                value, pos = _read_varint(data, pos)
+            case 1:
+                value, pos = data[pos:pos + 8], pos + 8
+            case 2:
+                size, pos = _read_varint(data, pos)
+                value, pos = data[pos:pos + size], pos + size
+            case 5:
+                value, pos = data[pos:pos + 4], pos + 4
+            case _:
+                raise ValueError(f'Unsupported wire type: {wire_type}')
+        yield number, value
+
+
+def _read_varint(data: bytes, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
@@ -0,0 +1,128 @@
+import os
+import shutil
+import struct
+from typing import BinaryIO, Iterator
+
+# Sparse images are only read. Shipped images stay raw, flashDiff and the delta package compare them block by block with the
+# partitions on the device, and zero ranges cost next to nothing once the zip is compressed
+_MAGIC = 0xed26ff3a
+_MAJOR_VERSION = 1
+# @formatter:off
+_HEADER_FORMAT_STRING = ('<I'   # magic
+                         'H'    # major version
+                         'H'    # minor version
+                         'H'    # file header size
+                         'H'    # chunk header size
+                         'I'    # block size
+                         'I'    # total blocks
+                         'I'    # total chunks
+                         'I')   # image checksum
+_CHUNK_FORMAT_STRING = ('<H'  # chunk type
+                        'H'   # reserved
+                        'I'   # chunk size in blocks
+                        'I')  # total size in bytes, header included
+# @formatter:on
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT_STRING)
+_CHUNK_HEADER_SIZE = struct.calcsize(_CHUNK_FORMAT_STRING)
+_CHUNK_TYPE_RAW = 0xcac1
+_CHUNK_TYPE_FILL = 0xcac2
+_CHUNK_TYPE_DONT_CARE = 0xcac3
+_CHUNK_TYPE_CRC32 = 0xcac4
+_BUFFER_SIZE = 1024 * 1024
+
+
+def is_sparse(file: str):
+    with open(file, 'rb') as f:
+        return f.read(4) == struct.pack('<I', _MAGIC)
+
+
+def raw_size(file: str):
+    if not is_sparse(file):
+        return os.path.getsize(file)
+    with open(file, 'rb') as f:
+        header = _read_header(f)
+    return header[5] * header[6]
+
+
+def read_head(file: str, size: int) -> bytes:
+    # The first bytes of the expanded image, enough to detect the file system inside a sparse image
+    if not is_sparse(file):
+        with open(file, 'rb') as f:
+            return f.read(size)
+    data = bytearray()
+    with open(file, 'rb') as f:
+        for _, chunk, length in _iter_chunks(f):
+            data += chunk if chunk is not None else bytes(length)
+            if len(data) >= size:
+                break
+    return bytes(data[:size])
+
+
+def copy_raw(file: str, output: BinaryIO) -> int:
+    # Writes the expanded image to a stream, don't care ranges become zeros
+    if not is_sparse(file):
+        with open(file, 'rb') as f:
+            shutil.copyfileobj(f, output, _BUFFER_SIZE)
+            return f.tell()
+    size = 0
+    zeros = memoryview(bytes(_BUFFER_SIZE))
+    with open(file, 'rb') as f:
+        for _, chunk, length in _iter_chunks(f):
+            if chunk is not None:
+                output.write(chunk)
+            else:
+                for position in range(0, length, _BUFFER_SIZE):
+                    output.write(zeros[:min(_BUFFER_SIZE, length - position)])
+            size += length
+    return size
+
+
+def unsparse(file: str, output: str):
+    # Don't care and zero fill ranges are skipped, they stay holes in the output file
+    with open(file, 'rb') as f, open(output, 'wb') as out:
+        header = _read_header(f)
+        for offset, chunk, length in _iter_chunks(f, header):
+            if chunk is not None and chunk.count(0) != len(chunk):
+                out.seek(offset)
+                out.write(chunk)
+        out.truncate(header[5] * header[6])
+
+
+def _read_header(f: BinaryIO):
+    f.seek(0)
+    header = struct.unpack(_HEADER_FORMAT_STRING, f.read(_HEADER_SIZE))
+    if header[0] != _MAGIC or header[1] != _MAJOR_VERSION:
+        raise ValueError('Invalid sparse image')
+    # Newer headers may be longer, skip the rest
+    f.seek(header[3])
+    return header
+
+
+def _iter_chunks(f: BinaryIO, header: tuple = None) -> Iterator[tuple[int, bytes | None, int]]:
+    # Yields (offset, data, length) of the expanded image in pieces, data is None for don't care ranges
+    header = header or _read_header(f)
+    block_size, total_chunks, chunk_header_size = header[5], header[7], header[4]
+    offset = 0
+    for _ in range(total_chunks):
+        chunk_type, _, chunk_blocks, total_size = struct.unpack(_CHUNK_FORMAT_STRING, f.read(_CHUNK_HEADER_SIZE))
+        f.seek(chunk_header_size - _CHUNK_HEADER_SIZE, os.SEEK_CUR)
+        length = chunk_blocks * block_size
+        if chunk_type == _CHUNK_TYPE_RAW:
+            if total_size - chunk_header_size != length:
+                raise ValueError(f'Invalid raw chunk size at {offset}')
+            for position in range(0, length, _BUFFER_SIZE):
+                data = f.read(min(_BUFFER_SIZE, length - position))
+                yield offset + position, data, len(data)
+        elif chunk_type == _CHUNK_TYPE_FILL:
+            value = f.read(4)
+            pattern = value * (_BUFFER_SIZE // 4)
+            for position in range(0, length, _BUFFER_SIZE):
+                piece = min(_BUFFER_SIZE, length - position)
+                yield offset + position, pattern[:piece], piece
+        elif chunk_type == _CHUNK_TYPE_DONT_CARE:
+            yield offset, None, length
+        elif chunk_type == _CHUNK_TYPE_CRC32:
+            f.seek(total_size - chunk_header_size, os.SEEK_CUR)
+        else:
+            raise ValueError(f'Unknown sparse chunk type: {chunk_type:#x}')
+        offset += length
@@ -0,0 +1,143 @@
+import hashlib
+import struct
+from typing import BinaryIO
+
+from util import sparseimg
+
+_SECTOR_SIZE = 512
+_RESERVED_BYTES = 4096
+_GEOMETRY_SIZE = 4096
+_GEOMETRY_MAGIC = 0x616c4467
+_HEADER_MAGIC = 0x414c5030
+_MAJOR_VERSION = 10
+_MINOR_VERSION = 2
+_HEADER_FLAG_VIRTUAL_AB_DEVICE = 0x1
+_PARTITION_ATTRIBUTES = {'none': 0x0, 'readonly': 0x1}
+_TARGET_TYPE_LINEAR = 0
+_DEFAULT_GROUP = 'default'
+_ALIGNMENT = 1024 * 1024
+_BLOCK_SIZE = 4096
+# @formatter:off
+_GEOMETRY_FORMAT_STRING = ('<I'    # magic
+                           'I'     # struct size
+                           '32s'   # checksum
+                           'I'     # metadata max size
+                           'I'     # metadata slot count
+                           'I')    # logical block size
+_HEADER_FORMAT_STRING = ('<I'      # magic
+                         'H'       # major version
+                         'H'       # minor version
+                         'I'       # header size
+                         '32s'     # header checksum
+                         'I'       # tables size
+                         '32s'     # tables checksum
+                         '12I'     # partitions, extents, groups, block devices table descriptors
+                         'I'       # flags
+                         '124x')   # reserved
+_PARTITION_FORMAT_STRING = ('<36s'  # name
+                            'I'     # attributes
+                            'I'     # first extent index
+                            'I'     # num extents
+                            'I')    # group index
+_EXTENT_FORMAT_STRING = ('<Q'      # num sectors
+                         'I'       # target type
+                         'Q'       # target data
+                         'I')      # target source
+_GROUP_FORMAT_STRING = ('<36s'     # name
+                        'I'        # flags
+                        'Q')       # maximum size
+_BLOCK_DEVICE_FORMAT_STRING = ('<Q'    # first logical sector
+                               'I'     # alignment
+                               'I'     # alignment offset
+                               'Q'     # size
+                               '36s'   # partition name
+                               'I')    # flags
+# @formatter:on
+_ZEROS = memoryview(bytes(_ALIGNMENT))
+
+
+def write(output: BinaryIO, device_size: int, groups: dict[str, int], partitions: list[tuple[str, str, str, str | None]],
+          super_name: str = 'super', metadata_size: int = 65536, metadata_slots: int = 3):
+    # Same layout as "lpmake --virtual-ab --force-full-image": partitions are (name, attributes, group, image) tuples
+    metadata_end = _RESERVED_BYTES + _GEOMETRY_SIZE * 2 + metadata_size * metadata_slots * 2
+    first_logical_sector = _align(metadata_end, _ALIGNMENT) // _SECTOR_SIZE
+
+    group_names = [_DEFAULT_GROUP, *groups]
+    group_sizes = dict.fromkeys(group_names, 0)
+    partition_table = []
+    extent_table = []
+    layout = []
+    next_sector = first_logical_sector
+    for name, attributes, group, image in partitions:
+        first_extent_index = len(extent_table)
+        if image is not None and (size := sparseimg.raw_size(image)) > 0:
+            num_sectors = _align(size, _BLOCK_SIZE) // _SECTOR_SIZE
+            extent_table.append(struct.pack(_EXTENT_FORMAT_STRING, num_sectors, _TARGET_TYPE_LINEAR, next_sector, 0))
+            layout.append((next_sector * _SECTOR_SIZE, image))
+            group_sizes[group] += num_sectors * _SECTOR_SIZE
+            next_sector = _align((next_sector + num_sectors) * _SECTOR_SIZE, _ALIGNMENT) // _SECTOR_SIZE
+        partition_table.append(struct.pack(_PARTITION_FORMAT_STRING, name.encode(), _PARTITION_ATTRIBUTES[attributes],
+                                           first_extent_index, len(extent_table) - first_extent_index, group_names.index(group)))
+
+    for group, size in group_sizes.items():
+        if group != _DEFAULT_GROUP and size > groups[group]:
+            raise ValueError(f'Partition group {group} exceeds its maximum size: {size} > {groups[group]}')
+    if layout:
+        last_offset, last_image = layout[-1]
+        if last_offset + _align(sparseimg.raw_size(last_image), _BLOCK_SIZE) > device_size:
+            raise ValueError(f'Not enough space on device {super_name} for partitions')
+
+    group_table = [struct.pack(_GROUP_FORMAT_STRING, name.encode(), 0, groups.get(name, 0)) for name in group_names]
+    block_device_table = [struct.pack(_BLOCK_DEVICE_FORMAT_STRING, first_logical_sector, _ALIGNMENT, 0, device_size, super_name.encode(), 0)]
+
+    geometry = _geometry(metadata_size, metadata_slots)
+    metadata = _metadata(partition_table, extent_table, group_table, block_device_table).ljust(metadata_size, b'\0')
+    output.write(bytes(_RESERVED_BYTES))
+    output.write(geometry * 2)
+    output.write(metadata * (metadata_slots * 2))
+
+    position = metadata_end
+    for offset, image in layout:
+        _write_zeros(output, offset - position)
+        size = sparseimg.copy_raw(image, output)
+        padding = _align(size, _BLOCK_SIZE) - size
+        _write_zeros(output, padding)
+        position = offset + size + padding
+    _write_zeros(output, device_size - position)
+
+
+def _geometry(metadata_size: int, metadata_slots: int):
+    geometry_size = struct.calcsize(_GEOMETRY_FORMAT_STRING)
+    fields = (_GEOMETRY_MAGIC, geometry_size, bytes(32), metadata_size, metadata_slots, _BLOCK_SIZE)
+    checksum = hashlib.sha256(struct.pack(_GEOMETRY_FORMAT_STRING, *fields)).digest()
+    geometry = struct.pack(_GEOMETRY_FORMAT_STRING, fields[0], fields[1], checksum, *fields[3:])
+    return geometry.ljust(_GEOMETRY_SIZE, b'\0')
+
+
+def _metadata(*tables: list[bytes]):
+    header_size = struct.calcsize(_HEADER_FORMAT_STRING)
+    descriptors = []
+    offset = 0
+    for table, format_string in zip(tables, (_PARTITION_FORMAT_STRING, _EXTENT_FORMAT_STRING, _GROUP_FORMAT_STRING, _BLOCK_DEVICE_FORMAT_STRING)):
+        descriptors += (offset, len(table), struct.calcsize(format_string))
+        offset += sum(len(entry) for entry in table)
+    tables_data = b''.join(b''.join(table) for table in tables)
+    tables_checksum = hashlib.sha256(tables_data).digest()
+
+    def header(checksum: bytes):
+        return struct.pack(_HEADER_FORMAT_STRING, _HEADER_MAGIC, _MAJOR_VERSION, _MINOR_VERSION, header_size, checksum,
+                           len(tables_data), tables_checksum, *descriptors, _HEADER_FLAG_VIRTUAL_AB_DEVICE)
+
+    header_checksum = hashlib.sha256(header(bytes(32))).digest()
+    return header(header_checksum) + tables_data
+
+
+def _write_zeros(output: BinaryIO, size: int):
+    while size > 0:
+        chunk = min(size, len(_ZEROS))
+        output.write(_ZEROS[:chunk])
+        size -= chunk
+
+
+def _align(value: int, alignment: int):
+    return (value + alignment - 1) // alignment * alignment
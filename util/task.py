@@ -0,0 +1,95 @@
+import io
+import subprocess
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Iterable
+
+import ccglobal
+from util import trace
+
+
+def run(cmd: list[str], *, check: bool = True, cwd: str = None):
+    if not ccglobal.is_log_buffered():
+        return trace.run(cmd, check=check, cwd=cwd, stderr=subprocess.STDOUT)
+
+    process = trace.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+    ccglobal.write_log(process.stdout)
+    if check:
+        process.check_returncode()
+    return process
+
+
+def run_parallel(func: Callable, items: Iterable, jobs: int) -> dict:
+    items = tuple(items)
+    if jobs <= 1 or len(items) <= 1:
+        return {item: func(item) for item in items}
+
+    results = {}
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(_call_buffered, func, item): item for item in items}
+        try:
+            for future in as_completed(futures):
+                result, output = future.result()
+                ccglobal.write_log(output)
+                results[futures[future]] = result
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def run_exclusive(jobs: Iterable[tuple[Callable, tuple[str, ...]]], processes: int):
+    # Each job declares the paths it touches, jobs whose paths overlap never run at the same time
+    pending = list(jobs)
+    if processes <= 1:
+        for func, _ in pending:
+            func()
+        return
+
+    running: dict[Future, tuple[str, ...]] = {}
+    with ProcessPoolExecutor(processes, initializer=trace.enable if trace.is_enabled() else None) as executor:
+        try:
+            while pending or running:
+                busy = [x for paths in running.values() for x in paths]
+                for job in pending[:]:
+                    if len(running) >= processes:
+                        break
+                    func, paths = job
+                    if any(_is_overlapped(x, y) for x in paths for y in busy):
+                        continue
+                    pending.remove(job)
+                    running[executor.submit(_call_isolated, func)] = paths
+                    busy.extend(paths)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    _, output, events = future.result()
+                    ccglobal.write_log(output)
+                    trace.merge(events)
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+
+def _is_overlapped(path1: str, path2: str):
+    return path1 == path2 or path1.startswith(f'{path2}/') or path2.startswith(f'{path1}/')
+
+
+def _call_isolated(func: Callable):
+    # Runs in a worker process, hand its logs and trace events back to the parent
+    with trace.collect() as events:
+        result, output = _call_buffered(func)
+    return result, output, events
+
+
+def _call_buffered(func: Callable, *args):
+    output = io.StringIO()
+    try:
+        with ccglobal.buffered_log(output):
+            result = func(*args)
+    except BaseException:
+        ccglobal.write_log(output.getvalue())
+        raise
+    return result, output.getvalue()
@@ -0,0 +1,205 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import ccglobal
+
+# Only imported once tracing is enabled, so that psutil is not needed for a normal build
+psutil = None
+
+_SAMPLE_INTERVAL = 0.1
+_TRACE_JSON = 'trace.json'
+_SUMMARY_JSON = 'trace_summary.json'
+
+_enabled = False
+_events = []
+_events_lock = threading.Lock()
+
+
+def enable():
+    global _enabled, psutil
+    import psutil
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+class Span:
+    # Wall time, cpu time, peak rss and io of a stage or an external tool, sampled from the process while the span is open
+    def __init__(self, name: str, category: str, pid: int = None, **args):
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+        if not _enabled:
+            return
+
+        try:
+            self._process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            self._process = None
+        self._include_children = pid is None
+        self._lock = threading.Lock()
+        self._first = self._last = self._sample()
+        self._peak_rss = self._first['rss'] if self._first else 0
+        self._start = time.time()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run_sampler, daemon=True)
+        self._sampler.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end()
+
+    def end(self):
+        if self._start is None:
+            return
+        end = time.time()
+        self._stop.set()
+        self._sampler.join()
+        self._update(self._sample())
+
+        usage = {'wall': round(end - self._start, 3), 'cpu': 0, 'peak_rss': self._peak_rss, 'read_bytes': 0, 'write_bytes': 0}
+        if self._first and self._last:
+            usage['cpu'] = round(self._last['cpu'] - self._first['cpu'], 3)
+            usage['read_bytes'] = self._last['read_bytes'] - self._first['read_bytes']
+            usage['write_bytes'] = self._last['write_bytes'] - self._first['write_bytes']
+        event = {'name': self._name, 'cat': self._category, 'ph': 'X', 'ts': int(self._start * 1e6), 'dur': int((end - self._start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': {**self._args, **usage}}
+        with _events_lock:
+            _events.append(event)
+        self._start = None
+
+    def _run_sampler(self):
+        while not self._stop.wait(_SAMPLE_INTERVAL):
+            self._update(self._sample())
+
+    def sample(self):
+        if self._start is not None:
+            self._update(self._sample())
+
+    def _update(self, sample: dict | None):
+        # The tool may already have exited, keep the last values seen
+        if sample is None:
+            return
+        with self._lock:
+            self._peak_rss = max(self._peak_rss, sample['rss'])
+            if self._first is None:
+                self._first = sample
+            # The sampler thread and the exit sample may race, keep the latest counters
+            if self._last is None or sample['cpu'] >= self._last['cpu']:
+                self._last = sample
+
+    def _sample(self):
+        if self._process is None:
+            return None
+        try:
+            with self._process.oneshot():
+                cpu_times = self._process.cpu_times()
+                memory = self._process.memory_info()
+                try:
+                    io = self._process.io_counters()
+                except (AttributeError, psutil.AccessDenied):
+                    io = None
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return None
+
+        cpu = cpu_times.user + cpu_times.system
+        if self._include_children:
+            cpu += cpu_times.children_user + cpu_times.children_system
+        return {'cpu': cpu, 'rss': getattr(memory, 'peak_wset', memory.rss),
+                'read_bytes': io.read_bytes if io else 0, 'write_bytes': io.write_bytes if io else 0}
+
+
+def watch(process: subprocess.Popen, cmd: list[str] = None):
+    cmd = cmd or process.args
+    span = Span(os.path.splitext(os.path.basename(cmd[0]))[0], 'tool', process.pid, cmd=subprocess.list2cmdline(cmd))
+    if not _enabled or not hasattr(os, 'waitid'):
+        # Popen keeps a handle to the process on Windows, so the sample at the end of span still sees the final counters
+        return span
+
+    # The last interval of a tool, or all of a short one, is only seen by a sample taken as it exits. The wait of Popen reaps
+    # the process, so it first waits without reaping and samples the zombie, which still holds the final counters.
+    # A process watched again, like the APKEditor server once per job, keeps its wrapper and only moves it to the new span
+    watched = hasattr(process, '_trace_span')
+    process._trace_span = span
+    if watched:
+        return span
+    wait = process.wait
+
+    def wait_sampled(timeout: float = None):
+        if process.returncode is None and timeout is None:
+            try:
+                os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+                process._trace_span.sample()
+            except ChildProcessError:
+                pass
+        return wait(timeout)
+
+    process.wait = wait_sampled
+    return span
+
+
+def run(cmd: list[str], *, check: bool = False, **kwargs) -> subprocess.CompletedProcess:
+    if not _enabled:
+        return subprocess.run(cmd, check=check, **kwargs)
+
+    with subprocess.Popen(cmd, **kwargs) as process:
+        with watch(process):
+            try:
+                stdout, stderr = process.communicate()
+            except BaseException:
+                process.kill()
+                raise
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+@contextmanager
+def collect():
+    # Gather the events of a worker process, so that they can be sent back and merged into the parent
+    global _events
+    events = []
+    previous, _events = _events, events
+    try:
+        yield events
+    finally:
+        _events = previous
+
+
+def merge(events: list[dict]):
+    with _events_lock:
+        _events.extend(events)
+
+
+def export(out_dir: str = '.'):
+    if not _enabled:
+        return
+    with _events_lock:
+        events = sorted(_events, key=lambda x: x['ts'])
+
+    with open(f'{out_dir}/{_TRACE_JSON}', 'w', encoding='utf-8', newline='') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    fields = ('wall', 'cpu', 'read_bytes', 'write_bytes')
+    summary = {}
+    for event in events:
+        group = summary.setdefault(event['cat'], {}).setdefault(event['name'], dict.fromkeys(('count', *fields, 'peak_rss'), 0))
+        group['count'] += 1
+        for field in fields:
+            group[field] = round(group[field] + event['args'][field], 3)
+        group['peak_rss'] = max(group['peak_rss'], event['args']['peak_rss'])
+    with open(f'{out_dir}/{_SUMMARY_JSON}', 'w', encoding='utf-8', newline='') as f:
+        json.dump(summary, f, indent=4)
+
+    for name, usage in summary.get('stage', {}).items():
+        ccglobal.log(f'阶段: {name}, 耗时 {usage['wall']} 秒, CPU {usage['cpu']} 秒, 峰值内存 {usage['peak_rss'] // 1024 ** 2} MB')
+    ccglobal.log(f'性能跟踪文件: {os.path.abspath(f'{out_dir}/{_TRACE_JSON}')}')
@@ -0,0 +1,195 @@
+import collections
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+_STORED = 0
+_DEFLATED = 8
+_VERSION = 45  # ZIP64
+_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP64_LIMIT = 0xffffffff
+_DIRECTORY_ATTRIBUTE = 0x10
+_CHUNK_SIZE = 1024 * 1024
+_DICTIONARY_SIZE = 32 * 1024
+_COMPRESS_LEVEL = 6
+# @formatter:off
+_LOCAL_HEADER_FORMAT_STRING = ('<4s'  # signature
+                               'H'    # version needed to extract
+                               'H'    # flags
+                               'H'    # compression method
+                               'H'    # last modified time
+                               'H'    # last modified date
+                               'I'    # crc-32
+                               'I'    # compressed size
+                               'I'    # uncompressed size
+                               'H'    # file name length
+                               'H')   # extra field length
+_DATA_DESCRIPTOR_FORMAT_STRING = ('<4s'  # signature
+                                  'I'    # crc-32
+                                  'Q'    # compressed size
+                                  'Q')   # uncompressed size
+_CENTRAL_HEADER_FORMAT_STRING = ('<4s'  # signature
+                                 'H'    # version made by
+                                 'H'    # version needed to extract
+                                 'H'    # flags
+                                 'H'    # compression method
+                                 'H'    # last modified time
+                                 'H'    # last modified date
+                                 'I'    # crc-32
+                                 'I'    # compressed size
+                                 'I'    # uncompressed size
+                                 'H'    # file name length
+                                 'H'    # extra field length
+                                 'H'    # file comment length
+                                 'H'    # disk number start
+                                 'H'    # internal file attributes
+                                 'I'    # external file attributes
+                                 'I')   # local header offset
+_ZIP64_EXTRA_FORMAT_STRING = ('<H'  # header id
+                              'H'   # data size
+                              'Q'   # uncompressed size
+                              'Q')  # compressed size
+_ZIP64_END_FORMAT_STRING = ('<4s'  # signature
+                            'Q'    # size of this record
+                            'H'    # version made by
+                            'H'    # version needed to extract
+                            'I'    # number of this disk
+                            'I'    # disk where central directory starts
+                            'Q'    # number of central directory records on this disk
+                            'Q'    # total number of central directory records
+                            'Q'    # size of central directory
+                            'Q')   # offset of central directory
+_ZIP64_LOCATOR_FORMAT_STRING = ('<4s'  # signature
+                                'I'    # disk with zip64 end of central directory
+                                'Q'    # offset of zip64 end of central directory
+                                'I')   # total number of disks
+_END_FORMAT_STRING = ('<4s'  # signature
+                      'H'    # number of this disk
+                      'H'    # disk where central directory starts
+                      'H'    # number of central directory records on this disk
+                      'H'    # total number of central directory records
+                      'I'    # size of central directory
+                      'I'    # offset of central directory
+                      'H')   # comment length
+# @formatter:on
+
+_Entry = collections.namedtuple('_Entry', ('name', 'method', 'dos_time', 'crc', 'compressed_size', 'size', 'attributes', 'offset'))
+
+
+class ZipWriter:
+    # Streams entries with data descriptors, so every byte is written exactly once and can be hashed on the way out
+    def __init__(self, file: BinaryIO, jobs: int = 1, digest=None):
+        self._file = file
+        self._jobs = jobs
+        self._digest = digest
+        self._offset = 0
+        self._entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, path: str, arcname: str = None, compress: bool = True):
+        arcname = (arcname or path).replace(os.sep, '/')
+        dos_time = _dos_time(os.path.getmtime(path))
+        if os.path.isdir(path):
+            self._write_entry(arcname.rstrip('/') + '/', _STORED, dos_time, _DIRECTORY_ATTRIBUTE, iter(()))
+            return
+        with open(path, 'rb') as f:
+            chunks = iter(lambda: f.read(_CHUNK_SIZE), b'')
+            if compress:
+                self._write_entry(arcname, _DEFLATED, dos_time, 0, self._deflate(chunks))
+            else:
+                self._write_entry(arcname, _STORED, dos_time, 0, ((chunk, chunk) for chunk in chunks))
+
+    def write_tree(self, path: str, compress: bool = True):
+        self.write(path, compress=compress)
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in dirs + sorted(files):
+                self.write(os.path.join(root, name), compress=compress)
+
+    def close(self):
+        central_offset = self._offset
+        for entry in self._entries:
+            name = entry.name.encode('utf-8')
+            extra = struct.pack(_ZIP64_EXTRA_FORMAT_STRING, 0x0001, 24, entry.size, entry.compressed_size) + struct.pack('<Q', entry.offset)
+            self._write(struct.pack(_CENTRAL_HEADER_FORMAT_STRING, b'PK\1\2', _VERSION, _VERSION, _FLAG_DATA_DESCRIPTOR, entry.method,
+                                    entry.dos_time[1], entry.dos_time[0], entry.crc, _ZIP64_LIMIT, _ZIP64_LIMIT, len(name), len(extra),
+                                    0, 0, 0, entry.attributes, _ZIP64_LIMIT))
+            self._write(name)
+            self._write(extra)
+        central_size = self._offset - central_offset
+
+        zip64_end_offset = self._offset
+        count = len(self._entries)
+        self._write(struct.pack(_ZIP64_END_FORMAT_STRING, b'PK\6\6', struct.calcsize(_ZIP64_END_FORMAT_STRING) - 12, _VERSION, _VERSION,
+                                0, 0, count, count, central_size, central_offset))
+        self._write(struct.pack(_ZIP64_LOCATOR_FORMAT_STRING, b'PK\6\7', 0, zip64_end_offset, 1))
+        self._write(struct.pack(_END_FORMAT_STRING, b'PK\5\6', 0, 0, min(count, 0xffff), min(count, 0xffff),
+                                min(central_size, _ZIP64_LIMIT), min(central_offset, _ZIP64_LIMIT), 0))
+
+    def _write_entry(self, arcname: str, method: int, dos_time: tuple[int, int], attributes: int, chunks):
+        offset = self._offset
+        name = arcname.encode('utf-8')
+        extra = struct.pack(_ZIP64_EXTRA_FORMAT_STRING, 0x0001, 16, 0, 0)
+        self._write(struct.pack(_LOCAL_HEADER_FORMAT_STRING, b'PK\3\4', _VERSION, _FLAG_DATA_DESCRIPTOR, method, dos_time[1], dos_time[0],
+                                0, _ZIP64_LIMIT, _ZIP64_LIMIT, len(name), len(extra)))
+        self._write(name)
+        self._write(extra)
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        for data, compressed in chunks:
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            compressed_size += len(compressed)
+            self._write(compressed)
+
+        self._write(struct.pack(_DATA_DESCRIPTOR_FORMAT_STRING, b'PK\7\10', crc, compressed_size, size))
+        self._entries.append(_Entry(arcname, method, dos_time, crc, compressed_size, size, attributes, offset))
+
+    def _deflate(self, chunks):
+        # pigz-style: each chunk is a raw deflate block primed with the tail of the previous chunk and ends on a byte boundary,
+        # so the compressed chunks concatenate into one stream
+        def compress(data: bytes, dictionary: bytes, last: bool):
+            compressor = zlib.compressobj(_COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=dictionary) if dictionary else \
+                zlib.compressobj(_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+        with ThreadPoolExecutor(max(self._jobs, 1)) as executor:
+            pending = collections.deque()
+            dictionary = b''
+            data = next(chunks, b'')
+            while True:
+                following = next(chunks, None)
+                last = following is None
+                pending.append((data, executor.submit(compress, data, dictionary, last)))
+                if last:
+                    break
+                dictionary = data[-_DICTIONARY_SIZE:]
+                data = following
+                while len(pending) > self._jobs * 2:
+                    data_done, future = pending.popleft()
+                    yield data_done, future.result()
+            while pending:
+                data_done, future = pending.popleft()
+                yield data_done, future.result()
+
+    def _write(self, data: bytes):
+        self._file.write(data)
+        if self._digest:
+            self._digest.update(data)
+        self._offset += len(data)
+
+
+def _dos_time(timestamp: float):
+    t = time.localtime(max(timestamp, 315532800))
+    return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2